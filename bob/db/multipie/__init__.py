@@ -6,7 +6,9 @@
 """
 
 from .query import Database
-from .models import Client, Subworld, File, FileMultiview, Expression, Camera, Protocol, ProtocolPurpose
+from .async_query import AsyncDatabase
+from .index import FileIndex
+from .models import Client, Subworld, File, FileMultiview, FileRecord, Expression, Camera, Protocol, ProtocolPurpose
 
 def get_config():
   """Returns a string containing the configuration information.
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Reading of the Multi-PIE annotation (.pos) files, and of the annotation
+store into which they can be compiled.
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import concurrent.futures
+
+import numpy
+
+from .cache import write_atomically
+
+
+# The labels of the annotated points, depending on the number of points in the file
+LABELS = {
+  # profile annotations
+  6: ['eye', 'nose', 'mouth', 'lipt', 'lipb', 'chin'],
+  # half profile annotations
+  8: ['reye', 'leye', 'nose', 'mouthr', 'mouthl', 'lipt', 'lipb', 'chin'],
+  # frontal image annotations
+  16: ['reye', 'leye', 'reyeo', 'reyei', 'leyei', 'leyeo', 'nose', 'mouthr',
+       'mouthl', 'lipt', 'lipb', 'chin', 'rbrowo', 'rbrowi', 'lbrowi', 'lbrowo'],
+  # for inclomplete annotations, only the two eye locations are available
+  2: ['reye', 'leye'],
+}
+
+# The codes of the sets of labels in the annotation store, with the number of
+# points of each set; the code 0 marks files without (readable) annotations
+LABELSETS = {1: 2, 2: 6, 3: 8, 4: 16}
+
+# The name of the directory of the annotation store inside of the annotation
+# directory
+STORE_NAME = 'annotations.store'
+
+# The type of the arrays of annotations, see :py:func:`annotation_array`
+ANNOTATION_DTYPE = numpy.dtype([('id', 'i8'), ('labelset', 'u1'), ('coordinates', 'f8', (16, 2))])
+
+
+def read_annotation_file(annotation_file):
+  """Reads the given annotation file and returns the annotations as a
+  dictionary, e.g., {'reye':(re_y,re_x), 'leye':(le_y,le_x), ...}
+
+  Raises an IOError if the file cannot be read, and a ValueError if its number
+  of annotations is not handled.
+  """
+
+  try:
+    f = open(annotation_file)
+  except (IOError, OSError):
+    raise IOError("The annotation file '%s' was not found" % annotation_file)
+
+  annotations = {}
+  with f:
+    count = int(f.readline())
+    if count not in LABELS:
+      raise ValueError("The number %d of annotations in file '%s' is not handled." % (
+          count, annotation_file))
+    labels = LABELS[count]
+
+    for i in range(count):
+      line = f.readline()
+      positions = line.split()
+      assert len(positions) == 2
+      annotations[labels[i]] = (float(positions[1]), float(positions[0]))
+
+  return annotations
+
+
+def read_annotation_files(annotation_files, threads=8, errors=None, read=read_annotation_file):
+  """Reads the given annotation files concurrently with the given number of
+  threads, and returns the list of annotations in the same order.
+
+  The annotations of files that cannot be read are None. If an ``errors``
+  dictionary is given, the exception raised for each of these files is stored
+  in it, with the index of the file in ``annotation_files`` as key.
+
+  Each annotation file is read by calling ``read`` with it, which is
+  :py:func:`read_annotation_file` by default.
+  """
+
+  def task(annotation_file):
+    try:
+      return read(annotation_file), None
+    except Exception as e:
+      return None, e
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+    results = list(executor.map(task, annotation_files))
+
+  if errors is not None:
+    for i, (_, error) in enumerate(results):
+      if error is not None:
+        errors[i] = error
+  return [annotations for annotations, _ in results]
+
+
+def files_digest(files):
+  """Returns a digest of the given (id, path) pairs of the files of a
+  database, which does not depend on their order"""
+
+  digest = hashlib.sha1()
+  for id, path in sorted(files):
+    digest.update(('%d %s\n' % (id, path)).encode('utf-8'))
+  return digest.hexdigest()
+
+
+def write_annotation_store(directory, files, annotations, extension):
+  """Writes the given annotations into an annotation store in the given
+  directory, replacing the store that might exist there.
+
+  The store consists of an index with the label set and the offset of the
+  points of each file, indexed by the file id, and of a single array of 16
+  points per annotated file, which can both be memory-mapped (see
+  :py:class:`AnnotationStore`). The names of both arrays contain a new
+  generation token, and the file ``meta.json``, which refers to them, is
+  replaced last. Readers therefore always open the index and the points of
+  the same store. The arrays of the replaced store are removed afterwards.
+  The meta data contains the :py:func:`files_digest` of the files, so that the
+  store is not used with a database whose files have other ids.
+
+  Keyword parameters:
+
+  directory
+    The directory of the store; it is created if needed.
+
+  files
+    The (id, path) pairs of all files of the database.
+
+  annotations
+    The annotations of these files, in the same order; None for files without
+    annotations.
+
+  extension
+    The extension of the annotation files that were compiled.
+
+  Return value
+    The number of files with annotations in the store.
+  """
+
+  files = list(files)
+  file_ids = [id for id, _ in files]
+  array = annotation_array(file_ids, annotations)
+  annotated = array[array['labelset'] != 0]
+  max_id = max(file_ids) if file_ids else -1
+
+  index = numpy.zeros((max_id + 1,), dtype=[('labelset', 'u1'), ('offset', 'i4')])
+  index['labelset'][annotated['id']] = annotated['labelset']
+  index['offset'][annotated['id']] = numpy.arange(len(annotated))
+  coordinates = numpy.ascontiguousarray(annotated['coordinates'])
+
+  try:
+    with open(os.path.join(directory, 'meta.json')) as f:
+      previous = json.load(f)
+  except (IOError, OSError, ValueError):
+    previous = {}
+
+  generation = uuid.uuid4().hex
+  meta = {'files': len(file_ids), 'max_id': max_id, 'annotated': len(annotated), 'extension': extension,
+          'digest': files_digest(files), 'index': 'index-%s.npy' % generation, 'coordinates': 'coordinates-%s.npy' % generation}
+  write_atomically(os.path.join(directory, meta['index']), lambda f: numpy.save(f, index))
+  write_atomically(os.path.join(directory, meta['coordinates']), lambda f: numpy.save(f, coordinates))
+  # the meta data is written last, so that the store is only used once it is complete
+  write_atomically(os.path.join(directory, 'meta.json'), lambda f: f.write(json.dumps(meta).encode('utf-8')))
+
+  # readers that opened the previous arrays keep their memory maps
+  for key in ('index', 'coordinates'):
+    if key in previous and previous[key] != meta[key]:
+      try:
+        os.remove(os.path.join(directory, previous[key]))
+      except OSError:
+        pass
+  return len(annotated)
+
+
+def annotation_array(file_ids, annotations):
+  """Converts the given annotations into an array of type
+  :py:data:`ANNOTATION_DTYPE`, with one entry per file. Each entry contains the
+  id of the file, the code of the set of labels of its annotations (see
+  :py:data:`LABELSETS`) and the (y, x) coordinates of the points, in the order
+  of the labels in :py:data:`LABELS`. The coordinates of missing points are
+  NaN, and the code of files without annotations (None) is 0.
+  """
+
+  codes = dict((count, code) for code, count in LABELSETS.items())
+  file_ids = list(file_ids)
+  array = numpy.zeros((len(file_ids),), dtype=ANNOTATION_DTYPE)
+  array['id'] = file_ids
+  array['coordinates'] = numpy.nan
+  for i, annotation in enumerate(annotations):
+    if annotation is None:
+      continue
+    labels = LABELS[len(annotation)]
+    array['labelset'][i] = codes[len(labels)]
+    array['coordinates'][i, :len(labels)] = [annotation[label] for label in labels]
+  return array
+
+
+class AnnotationStore(object):
+  """Gives access to the annotations compiled with
+  :py:func:`write_annotation_store`. The arrays of the store are memory-mapped,
+  so that opening the store is cheap and the annotations of a file are looked
+  up without opening any file.
+
+  Keyword parameters:
+
+  directory
+    The directory of the store; an IOError is raised if it contains no
+    complete store.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    # the arrays of the store might be removed by a new compilation after the
+    # meta data was read; the meta data of the new store is read then
+    for attempt in range(2):
+      try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+          self.meta = json.load(f)
+        self.index = numpy.load(os.path.join(directory, self.meta['index']), mmap_mode='r')
+        self.coordinates = numpy.load(os.path.join(directory, self.meta['coordinates']), mmap_mode='r')
+        break
+      except (IOError, OSError, ValueError, KeyError):
+        if attempt:
+          raise IOError("The annotation store '%s' cannot be read" % directory)
+    if len(self.index) != self.meta['max_id'] + 1 or len(self.coordinates) != self.meta['annotated']:
+      raise IOError("The annotation store '%s' is incomplete" % directory)
+
+  def matches(self, digest, extension):
+    """Tells if the store was compiled for a database whose files have the
+    given :py:func:`files_digest`, and from annotation files with the given
+    extension"""
+
+    return (self.meta.get('digest'), self.meta['extension']) == (digest, extension)
+
+  def get(self, file_id):
+    """Returns the annotations of the file with the given id as a dictionary,
+    see :py:func:`read_annotation_file`, or None if the store has none for this
+    file"""
+
+    if not 0 <= file_id < len(self.index):
+      return None
+    labelset, offset = self.index[file_id]
+    if not labelset:
+      return None
+    points = self.coordinates[offset]
+    return dict((label, (float(points[i, 0]), float(points[i, 1]))) for i, label in enumerate(LABELS[LABELSETS[labelset]]))
+
+  def array(self, file_ids):
+    """Returns the annotations of the files with the given ids as an array of
+    type :py:data:`ANNOTATION_DTYPE`, see :py:func:`annotation_array`"""
+
+    file_ids = numpy.asarray(file_ids, dtype=numpy.int64).reshape(-1)
+    array = numpy.zeros((len(file_ids),), dtype=ANNOTATION_DTYPE)
+    array['id'] = file_ids
+    array['coordinates'] = numpy.nan
+    stored = (file_ids >= 0) & (file_ids < len(self.index))
+    entries = self.index[file_ids[stored]]
+    annotated = numpy.flatnonzero(stored)[entries['labelset'] != 0]
+    entries = entries[entries['labelset'] != 0]
+    array['labelset'][annotated] = entries['labelset']
+    array['coordinates'][annotated] = self.coordinates[entries['offset']]
+    return array
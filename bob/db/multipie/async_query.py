@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides an asyncio interface to the Multi-PIE database, which
+runs the queries without blocking the event loop.
+"""
+
+import asyncio
+import functools
+import threading
+import concurrent.futures
+
+from .query import Database
+
+
+class AsyncDatabase(object):
+  """Runs the queries of :py:class:`bob.db.multipie.Database` in a pool of
+  threads, so that they can be awaited in an asyncio event loop, e.g.::
+
+    async with AsyncDatabase(annotation_directory='...') as db:
+      files = await db.objects(protocol='M', groups='dev', lite=True)
+      annotations = await db.annotations_many(files)
+
+  Each thread of the pool uses its own :py:class:`Database`, i.e., its own
+  connection to the database, and the methods return the same results as the
+  ones of the :py:class:`Database`. As the returned ``File`` objects belong to
+  the connection of the thread that queried them, their relationships should
+  be loaded with the query (``eager=True``), or ``lite`` records should be
+  requested, when they are used outside of the pool.
+
+  Keyword parameters:
+
+  max_workers
+    The maximum number of queries that are run at the same time.
+
+  kwargs
+    The parameters of the :py:class:`Database` of each thread.
+  """
+
+  def __init__(self, max_workers=4, **kwargs):
+    self._kwargs = kwargs
+    self._max_workers = max(1, max_workers)
+    self._local = threading.local()
+    self._databases = []
+    self._lock = threading.Lock()
+    self._closed = False
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers)
+
+  def _database(self):
+    """Returns the database of the current thread, which is opened at the
+    first call"""
+
+    if not hasattr(self._local, 'database'):
+      self._local.database = Database(**self._kwargs)
+      with self._lock:
+        self._databases.append(self._local.database)
+    return self._local.database
+
+  def _close_database(self, barrier):
+    """Closes the database of the current thread. The connections of SQLite
+    can only be closed by the thread that opened them; the barrier makes every
+    thread of the pool run this function once."""
+
+    barrier.wait()
+    database = getattr(self._local, 'database', None)
+    if database is None:
+      return
+    del self._local.database
+    with self._lock:
+      self._databases.remove(database)
+    if database.m_session is not None:
+      database.m_session.close()
+      database.m_session.bind.dispose()
+      database.m_session = None
+
+  def _call(self, function, args, kwargs):
+    """Calls the given function with the database of the current thread"""
+
+    return function(self._database(), *args, **kwargs)
+
+  async def run(self, function, *args, **kwargs):
+    """Calls ``function(database, *args, **kwargs)`` in the pool of threads
+    with the :py:class:`Database` of the thread, and returns its result. This
+    gives access to the methods of the :py:class:`Database` that are not
+    wrapped by this class."""
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self._executor, functools.partial(self._call, function, args, kwargs))
+
+  async def objects(self, *args, **kwargs):
+    """Returns the files of the database, see :py:meth:`Database.objects`"""
+    return await self.run(Database.objects, *args, **kwargs)
+
+  async def object_ids(self, *args, **kwargs):
+    """Returns the ids of the files of the database, see
+    :py:meth:`Database.object_ids`"""
+    return await self.run(Database.object_ids, *args, **kwargs)
+
+  async def clients(self, *args, **kwargs):
+    """Returns the clients of the database, see :py:meth:`Database.clients`"""
+    return await self.run(Database.clients, *args, **kwargs)
+
+  async def model_ids(self, *args, **kwargs):
+    """Returns the ids of the models of the database, see
+    :py:meth:`Database.model_ids`"""
+    return await self.run(Database.model_ids, *args, **kwargs)
+
+  async def annotations(self, file):
+    """Returns the annotations of the given file, see
+    :py:meth:`Database.annotations`"""
+    return await self.run(Database.annotations, file)
+
+  async def annotations_many(self, *args, **kwargs):
+    """Returns the annotations of several files, see
+    :py:meth:`Database.annotations_many`"""
+    return await self.run(Database.annotations_many, *args, **kwargs)
+
+  async def annotation_array(self, *args, **kwargs):
+    """Returns the annotations of several files as an array, see
+    :py:meth:`Database.annotation_array`"""
+    return await self.run(Database.annotation_array, *args, **kwargs)
+
+  def close(self):
+    """Waits for the running queries, closes the database of each thread and
+    stops the pool of threads"""
+
+    if self._closed:
+      return
+    self._closed = True
+    if self._databases:
+      barrier = threading.Barrier(self._max_workers)
+      closing = [self._executor.submit(self._close_database, barrier) for _ in range(self._max_workers)]
+      for future in closing:
+        future.result()
+    self._executor.shutdown(wait=True)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    # do not block the event loop while waiting for the running queries
+    await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the creation of the Multi-PIE database on a synthetic copy of
+the image directory, e.g.::
+
+  $ python bob/db/multipie/benchmark.py /tmp/multipie-benchmark -P -E -H
+
+At the first run, empty image files of all 346 clients and their subject list
+are written into the given directory (about 128,000 files). The database is
+then created in there, with the given options of the ``create`` command, and
+the wall time of the whole creation and of each of its phases is printed.
+
+The phases are timed by wrapping the functions of
+``bob.db.multipie.create``, so that other versions of this package can be
+measured as well: put a checkout of the other version first in the
+``PYTHONPATH`` when running this script.
+"""
+
+import os
+import time
+import random
+import argparse
+
+CAMERAS = ['24_0', '01_0', '20_0', '19_0', '04_1', '19_1', '05_0', '05_1', '14_0', '08_1', '13_0', '08_0', '09_0', '12_0', '11_0']
+RECORDINGS = {1: [1, 2], 2: [1, 2, 3], 3: [1, 2, 3], 4: [1, 2, 3]}
+PHASES = ['create_tables', 'add_clients', 'add_subworlds', 'add_files', 'add_ordinals', 'add_protocols', 'finalize']
+
+def write_tree(directory, clients=None, seed=4):
+  """Writes the subject list ``subjects.txt`` of all 346 clients and the image
+  directory ``data`` of a synthetic Multi-PIE database into the given
+  directory. The images of the given ``clients`` (by default, all) are
+  written: all 15 cameras of the multiview images, 19 shots of the frontal
+  camera and 3 shots of the other cameras, and one high-resolution image per
+  recording. The sessions of the clients are drawn at random. Returns the
+  number of images."""
+
+  generator = random.Random(seed)
+  sessions = {}
+  with open(os.path.join(directory, 'subjects.txt'), 'w') as f:
+    for c in range(1, 347):
+      attended = [generator.random() < 0.6 for _ in range(4)]
+      if c % 7 == 0: attended = [False, False, False, True]
+      if c % 11 == 0: attended = [True, False, False, True]
+      if not any(attended): attended[generator.randrange(4)] = True
+      sessions[c] = [s for s in range(1, 5) if attended[s-1]]
+      f.write('%03d %d %s %s\n' % (c, 1950 + c % 50, generator.choice(['Male', 'Female']), ' '.join('1' if a else '0' for a in attended)))
+
+  imagedir = os.path.join(directory, 'data')
+  count = 0
+  for c in (range(1, 347) if clients is None else clients):
+    for s in sessions[c]:
+      for r in RECORDINGS[s]:
+        for camera in CAMERAS:
+          d = os.path.join(imagedir, 'session%02d' % s, 'multiview', '%03d' % c, '%02d' % r, camera)
+          os.makedirs(d)
+          for shot in (range(19) if camera == '05_1' else [0, 1, 5]):
+            open(os.path.join(d, '%03d_%02d_%02d_%s_%02d.png' % (c, s, r, camera.replace('_', ''), shot)), 'w').close()
+            count += 1
+        d = os.path.join(imagedir, 'session%02d' % s, 'highres', '%03d' % c)
+        if not os.path.exists(d):
+          os.makedirs(d)
+        open(os.path.join(d, '%03d_%02d_hr.jpg' % (c, r)), 'w').close()
+        count += 1
+  return count
+
+def create_database(directory, dbfile, options=(), profiler=None):
+  """Runs the ``create`` command with the given options, which creates the
+  given database file from the synthetic database in the given directory (see
+  :py:func:`write_tree`). The statistics of the creation are collected by the
+  given :py:class:`bob.db.multipie.create.Profiler`, if any."""
+
+  from bob.db.multipie import create
+
+  subparsers = argparse.ArgumentParser().add_subparsers()
+  create.add_command(subparsers)
+  args = subparsers.choices['create'].parse_args(['-D', os.path.join(directory, 'data'), '--subjectlist', os.path.join(directory, 'subjects.txt')] + list(options))
+  args.type, args.files = 'sqlite', [dbfile]
+  if args.verbose is None: args.verbose = 0
+  if profiler is None:
+    args.func(args)
+  else:
+    args.func(args, profiler)
+
+def main(command_line=None):
+
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('directory', help="The directory of the synthetic database")
+  parser.add_argument('options', nargs=argparse.REMAINDER, help="The options of the create command, e.g., -P -E -H")
+  args = parser.parse_args(command_line)
+
+  from bob.db.multipie import create
+
+  if not os.path.exists(os.path.join(args.directory, 'subjects.txt')):
+    if not os.path.exists(args.directory):
+      os.makedirs(args.directory)
+    print("Writing %d images into '%s'..." % (write_tree(args.directory), args.directory))
+
+  # the phases that exist in this version are timed
+  seconds = {}
+  def timed(name, function):
+    def wrapper(*a, **k):
+      start = time.time()
+      try:
+        return function(*a, **k)
+      finally:
+        seconds[name] = seconds.get(name, 0.) + time.time() - start
+    return wrapper
+  for name in PHASES:
+    if hasattr(create, name):
+      setattr(create, name, timed(name, getattr(create, name)))
+
+  dbfile = os.path.join(os.path.abspath(args.directory), 'db.sql3')
+  if os.path.exists(dbfile):
+    os.unlink(dbfile)
+
+  start = time.time()
+  create_database(args.directory, dbfile, args.options)
+  total = time.time() - start
+
+  for name in PHASES:
+    if name in seconds:
+      print('%-14s %8.2f s' % (name, seconds[name]))
+  print('%-14s %8.2f s' % ('total', total))
+
+if __name__ == '__main__':
+  main()
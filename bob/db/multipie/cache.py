@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Caches for the results of the queries to the Multi-PIE database.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import collections
+import collections.abc
+import threading
+
+import numpy
+
+
+def normalize(value):
+  """Turns a query parameter into a hashable value, which is the same for all
+  spellings of the same query (a single value, a list or a tuple in any
+  order)"""
+
+  if value is None:
+    return None
+  if isinstance(value, (str, bytes)) or not isinstance(value, collections.abc.Iterable):
+    return (value,)
+  return tuple(sorted(value))
+
+
+class LRUCache(object):
+  """A mapping with a maximum number of entries, which drops the least recently
+  used entry when it is full. It can be shared between threads.
+
+  Keyword parameters:
+
+  capacity
+    The maximum number of entries; 0 disables the cache.
+  """
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default=None):
+    """Returns the value stored for the given key, or ``default``"""
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key]
+      self.misses += 1
+      return default
+
+  def put(self, key, value):
+    """Stores the value for the given key, dropping the least recently used
+    entries if the cache is full"""
+    if self.capacity <= 0:
+      return
+    with self._lock:
+      self._entries[key] = value
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.capacity:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    """Removes all entries, but keeps the statistics"""
+    with self._lock:
+      self._entries.clear()
+
+  def info(self):
+    """Returns the number of hits and misses, the current number of entries
+    and the capacity of the cache"""
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'capacity': self.capacity}
+
+
+class ResultStore(object):
+  """Stores the ids of the files returned by queries on disk, so that they can
+  be shared between processes. The results are stored per content of the
+  database file, and written atomically, so that several processes may write
+  to the same directory.
+
+  Keyword parameters:
+
+  directory
+    The directory where the results are stored; it is created if needed.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def database_hash(self, filename):
+    """Returns the SHA-1 hash of the content of the given database file.
+
+    The hash is kept in a small file next to the results, and only computed
+    again when the size, modification time or inode of the database file
+    changes."""
+
+    stat = os.stat(filename)
+    signature = [stat.st_size, stat.st_mtime, stat.st_ino]
+    sidecar = os.path.join(self.directory, 'database-%s.json' % hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest())
+    try:
+      with open(sidecar) as f:
+        stored = json.load(f)
+      if stored['signature'] == signature:
+        return stored['hash']
+    except (IOError, OSError, ValueError, KeyError):
+      pass
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        sha1.update(chunk)
+    digest = sha1.hexdigest()
+    self._write(sidecar, lambda f: f.write(json.dumps({'signature': signature, 'hash': digest}).encode('utf-8')))
+    return digest
+
+  def path(self, database_hash, key):
+    """Returns the name of the file that stores the result for the given key,
+    which must be serializable to JSON"""
+
+    name = hashlib.sha1(json.dumps(key, sort_keys=True, default=int).encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, database_hash, name + '.npy')
+
+  def load(self, path):
+    """Returns the ids stored in the given file, or None if there are none"""
+
+    try:
+      return numpy.load(path)
+    except (IOError, OSError, ValueError):
+      return None
+
+  def save(self, path, ids):
+    """Stores the given ids in the given file"""
+
+    self._write(path, lambda f: numpy.save(f, numpy.asarray(ids, dtype=numpy.int64)))
+
+  def _write(self, path, write):
+    """Writes the given file atomically, see :py:func:`write_atomically`"""
+
+    write_atomically(path, write)
+
+
+def write_atomically(path, write):
+  """Writes a file through a temporary file in the same directory, which
+  replaces the destination once it is complete. The directory is created if
+  needed. The file gets the read and write permissions of the directory, so
+  that it can be read by everyone who can list the directory.
+
+  Keyword parameters:
+
+  path
+    The name of the file to write.
+
+  write
+    A function that writes the content to the binary file object it is given.
+  """
+
+  directory = os.path.dirname(path)
+  if directory and not os.path.exists(directory):
+    try:
+      os.makedirs(directory)
+    except OSError:
+      # created by another process in the meantime
+      if not os.path.isdir(directory):
+        raise
+  fd, temporary = tempfile.mkstemp(dir=directory or os.curdir, suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      write(f)
+    # temporary files are only readable by their owner
+    os.chmod(temporary, os.stat(directory or os.curdir).st_mode & 0o666)
+    os.replace(temporary, path)
+  except:
+    os.remove(temporary)
+    raise
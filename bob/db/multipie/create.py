@@ -20,7 +20,18 @@
 """
 
 import os
+import sys
+import gzip
+import json
+import time
+import contextlib
 import fileinput
+import collections
+import concurrent.futures
+
+from sqlalchemy import func, literal, select, event, inspect, bindparam, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
 
 from .models import *
 
@@ -86,20 +97,41 @@ def add_clients(session, filelist, verbose):
       first_session = 4
     #TODO: if first_session == 0: raises an error
 
-    if not (v[0] in client_dict):
+    if not (int(v[0]) in client_dict):
       group = 'world'
       if int(v[0]) in dev_ids: group = 'dev'
       elif int(v[0]) in eval_ids: group = 'eval'
       if verbose>1: print("Adding client '%d' ..." % int(v[0]))
       session.add(Client(int(v[0]), group, int(v[1]), v[2], first_session, second_session, third_session, fourth_session))
-      client_dict[v[0]] = True
+      client_dict[int(v[0])] = True
 
-  client_dict = {}
+  # clients that are already in the database are not added again
+  client_dict = dict((c_id, True) for (c_id,) in session.query(Client.id))
   for line in fileinput.input(filelist):
     add_client(session, line, client_dict, verbose)
 
-def add_subworlds(session, verbose):
-  """Adds splits in the world set, based on the client ids"""
+def read_subworlds(filename):
+  """Reads user-defined subworlds from the given file, which contains one
+  subworld per line: its name followed by the ids of its clients, separated
+  by white spaces. Empty lines and lines starting with ``#`` are ignored.
+  Returns a list of (name, client ids) tuples; a ValueError is raised if a
+  subworld is defined twice."""
+
+  subworlds = []
+  with open(filename) as f:
+    for line in f:
+      v = line.split()
+      if not v or v[0][0] == '#':
+        continue
+      if v[0] in [name for name, _ in subworlds]:
+        raise ValueError("The subworld '%s' is defined twice in '%s'" % (v[0], filename))
+      subworlds.append((v[0], [int(c_id) for c_id in v[1:]]))
+  return subworlds
+
+def add_subworlds(session, verbose, subworlds_file=None):
+  """Adds splits in the world set, based on the client ids.
+  Additional subworlds can be defined in the given file, see :py:func:`read_subworlds`;
+  their clients must belong to the world group."""
 
   # Lists for the subworld subsets
   l41 =  [ 21,  26,  31,  39,  66,  75,  81,  90,  98, 109, 114, 148, 152, 158, 165, 171, 174, 179, 182, 197,
@@ -126,127 +158,495 @@ def add_subworlds(session, verbose):
           295, 296, 297, 298, 299, 300, 301, 303, 304, 306, 308, 309, 310, 311, 312, 313, 314, 315, 317, 319,
           320, 321, 322, 323, 324, 325, 326, 327, 329, 333, 335, 336, 337, 338, 339, 341, 342, 343, 344, 345,
           346]
-  snames = ['sub41', 'sub81', 'sub121', 'sub161']
-  slist = [l41, l81, l121, l161]
-  for k in range(len(snames)):
-    if verbose: print("Adding subworld '%s'" %(snames[k], ))
-    su = Subworld(snames[k])
+  subworlds = [('sub41', l41), ('sub81', l81), ('sub121', l121), ('sub161', l161)]
+  client_ids = set(c_id for (c_id,) in session.query(Client.id))
+  if subworlds_file is not None:
+    world_ids = set(c_id for (c_id,) in session.query(Client.id).filter(Client.sgroup == 'world'))
+    for name, l in read_subworlds(subworlds_file):
+      if name in [k for k, _ in subworlds]:
+        raise ValueError("The subworld '%s' defined in '%s' is already defined" % (name, subworlds_file))
+      others = sorted((set(l) & client_ids) - world_ids)
+      if others:
+        raise ValueError("The subworld '%s' defined in '%s' contains clients that are not in the world group: %s" % (name, subworlds_file, others))
+      subworlds.append((name, l))
+
+  # the client memberships are directly written into the association table
+  existing = set(name for (name,) in session.query(Subworld.name))
+  for name, l in subworlds:
+    if name in existing:
+      continue
+    unknown = sorted(set(l) - client_ids)
+    if unknown:
+      raise ValueError("The subworld '%s' contains unknown client ids: %s" % (name, unknown))
+    if verbose: print("Adding subworld '%s' with %d clients" %(name, len(l)))
+    su = Subworld(name)
     session.add(su)
     session.flush()
-    session.refresh(su)
-    l = slist[k]
-    for c_id in l:
-      if verbose>1: print("Adding client '%d' to subworld '%s'..." %(c_id, snames[k]))
-      su.clients.append(session.query(Client).filter(Client.id == c_id).first())
+    # an insert without parameters would add a single row of NULL values
+    if l:
+      session.execute(subworld_client_association.insert(), [{'subworld_id': su.id, 'client_id': c_id} for c_id in l])
 
-def add_files(session, imagedir, illuminations, poses, expressions, highresolutions, verbose):
-  """Add files (and clients) to the Multi-PIE database."""
+class FileInserter(object):
+  """Collects File and FileMultiview rows and writes them to the database in
+  large batches (executemany), instead of flushing every single ORM object.
 
-  def add_mv_file(session, filename, session_id, client_id, recording_id, camera_name, expr_dict, cam_dict, expressions, verbose):
-    """Parse a single filename and add it to the list.
-       Also add a client entry if not already in the database."""
-    v = os.path.splitext(filename)[0].split('_')
-    shot_id = int(v[5])
-    if illuminations or shot_id == 0:
-      if verbose>1: print("Adding file (multiview) '%s' ..." %(filename,))
-      sid = int(session_id[8])
-      rid = int(recording_id)
-      eid = expr_dict[(sid,rid)][0]
-      ename = expr_dict[(sid,rid)][1]
-      cid = cam_dict[camera_name]
-      if (expressions == True or ename == 'neutral'):
-        f = File(int(client_id), filename, sid, rid, 'multiview', eid)
-        # We want to make use of the new assigned file id
-        # We need to do the following:
-        session.add(f)
-        session.flush()
-        session.refresh(f)
-        session.add(FileMultiview(f.id, shot_id, cid))
+  Before a batch is written, the files whose path is already stored in the
+  database are dropped. The remaining files get their ids assigned up front,
+  continuing after the largest id already stored in the database, so that the
+  FileMultiview rows can be written without asking the database for the newly
+  assigned id first. Every batch is committed and the session is cleared
+  afterwards, so that the memory usage does not grow with the number of files.
+  """
 
-  def add_hr_file(session, filename, session_id, client_id, expr_dict, expressions, verbose):
-    """Parse a single filename and add it to the list.
-       Also add a client entry if not already in the database."""
-    if verbose>1: print("Adding file (highres) '%s' ..." %(filename,))
-    v = os.path.splitext(filename)[0].split('_')
-    sid = int(session_id[8])
-    rid = int(v[1])
-    eid = expr_dict[(sid,rid)][0]
-    ename = expr_dict[(sid,rid)][1]
-    if (expressions == True or ename == 'neutral'):
-      session.add(File(int(client_id), filename, sid, rid, 'highres', eid))
+  def __init__(self, session, batch_size=10000):
+    self.session = session
+    self.batch_size = batch_size
+    self.count = 0
+    self.pending = collections.OrderedDict()
+
+  def add_multiview(self, client_id, path, session_id, recording_id, expression_id, shot_id, camera_id):
+    """Adds a multiview file"""
+    self.add_file(client_id, path, session_id, recording_id, 'multiview', expression_id, {'shot_id': shot_id, 'camera_id': camera_id})
+
+  def add_highres(self, client_id, path, session_id, recording_id, expression_id):
+    """Adds a high-resolution file"""
+    self.add_file(client_id, path, session_id, recording_id, 'highres', expression_id)
 
-  def add_expressions(session, verbose):
-    """Adds expressions"""
+  def add_file(self, client_id, path, session_id, recording_id, img_type, expression_id, multiview=None):
+    if path not in self.pending:
+      self.pending[path] = ({'client_id': client_id, 'path': path, 'session_id': session_id,
+                             'recording_id': recording_id, 'img_type': img_type, 'expression_id': expression_id}, multiview)
+      if len(self.pending) >= self.batch_size:
+        self.flush()
 
-    expr_list = ['neutral', 'smile', 'surprise', 'squint', 'disgust', 'scream']
-    expr_srid = [[(1,1), (2,1), (3,1), (4,1), (4,2)], [(1,2), (3,2)], [(2,2)], [(2,3)], [(3,3)], [(4,3)]]
-    expr_dict = {}
-    for k in range(len(expr_list)):
-      el = expr_list[k]
+  def flush(self):
+    """Writes all pending rows to the database and commits them"""
+    if not self.pending:
+      return
+
+    # drops the files that are already stored (SQLite allows 999 parameters per query)
+    paths = list(self.pending)
+    for i in range(0, len(paths), 900):
+      for (path,) in self.session.query(File.path).filter(File.path.in_(paths[i:i+900])):
+        del self.pending[path]
+
+    next_id = (self.session.query(func.max(File.id)).scalar() or 0) + 1
+    files = []
+    files_multiview = []
+    for f, mv in self.pending.values():
+      f['id'] = next_id
+      files.append(f)
+      if mv is not None:
+        mv['id'] = next_id
+        files_multiview.append(mv)
+      next_id += 1
+    self.pending = collections.OrderedDict()
+
+    # the file rows need to be written first, since fileMultiview references them
+    if files:
+      self.session.execute(File.__table__.insert(), files)
+    if files_multiview:
+      self.session.execute(FileMultiview.__table__.insert(), files_multiview)
+    self.count += len(files)
+
+    self.session.commit()
+    self.session.expunge_all()
+
+def add_expressions(session, verbose):
+  """Adds expressions"""
+
+  expr_list = ['neutral', 'smile', 'surprise', 'squint', 'disgust', 'scream']
+  expr_srid = [[(1,1), (2,1), (3,1), (4,1), (4,2)], [(1,2), (3,2)], [(2,2)], [(2,3)], [(3,3)], [(4,3)]]
+  expr_dict = {}
+  existing = dict((e.name, e) for e in session.query(Expression))
+  for k in range(len(expr_list)):
+    el = expr_list[k]
+    e = existing.get(el)
+    if e is None:
       if verbose: print("Adding expression '%s'..." % (el))
       e = Expression(el)
       session.add(e)
       session.flush()
       session.refresh(e)
-      indices = expr_srid[k]
-      for ind in indices:
-        expr_dict[ind] = [e.id, e.name]
-    return expr_dict
-
-  def add_cameras(session, verbose):
-    """Adds cameras"""
-
-    cam_list = ['24_0', '01_0', '20_0', '19_0', '04_1', '19_1', '05_0', '05_1', '14_0', '08_1',
-                '13_0', '08_0', '09_0', '12_0', '11_0']
-    cam_dict = {}
-    for el in cam_list:
-      if verbose: print("Adding cameras '%s'..." % (el))
-      c = Camera(el)
-      session.add(c)
-      session.flush()
-      session.refresh(c)
-      cam_dict[el] = c.id
-    return cam_dict
+    indices = expr_srid[k]
+    for ind in indices:
+      expr_dict[ind] = [e.id, e.name]
+  return expr_dict
+
+def add_cameras(session, verbose):
+  """Adds cameras"""
+
+  cam_list = ['24_0', '01_0', '20_0', '19_0', '04_1', '19_1', '05_0', '05_1', '14_0', '08_1',
+              '13_0', '08_0', '09_0', '12_0', '11_0']
+  cam_dict = dict((c.name, c.id) for c in session.query(Camera))
+  for el in cam_list:
+    if el in cam_dict:
+      continue
+    if verbose: print("Adding cameras '%s'..." % (el))
+    c = Camera(el)
+    session.add(c)
+    session.flush()
+    session.refresh(c)
+    cam_dict[el] = c.id
+  return cam_dict
+
+def add_mv_file(inserter, filename, expr_dict, cam_dict, illuminations, poses, expressions, verbose):
+  """Parse a single multiview path stem, e.g.,
+     'session01/multiview/001/01/05_1/001_01_01_051_00', and add it to the list."""
+  session_id, _, client_id, recording_id, camera_name, basename = filename.split('/')
+  # Check if it is the frontal camera 05_1
+  if ((not poses) and camera_name != '05_1'):
+    return
+  shot_id = int(basename.split('_')[4])
+  if illuminations or shot_id == 0:
+    if verbose>1: print("Adding file (multiview) '%s' ..." %(filename,))
+    sid = int(session_id[8])
+    rid = int(recording_id)
+    eid = expr_dict[(sid,rid)][0]
+    ename = expr_dict[(sid,rid)][1]
+    cid = cam_dict[camera_name]
+    if (expressions == True or ename == 'neutral'):
+      inserter.add_multiview(int(client_id), filename, sid, rid, eid, shot_id, cid)
+
+def add_hr_file(inserter, filename, expr_dict, expressions, verbose):
+  """Parse a single high-resolution path stem, e.g.,
+     'session01/highres/001/001_01_01_...', and add it to the list."""
+  session_id, _, client_id, basename = filename.split('/')
+  if verbose>1: print("Adding file (highres) '%s' ..." %(filename,))
+  sid = int(session_id[8])
+  rid = int(basename.split('_')[1])
+  eid = expr_dict[(sid,rid)][0]
+  ename = expr_dict[(sid,rid)][1]
+  if (expressions == True or ename == 'neutral'):
+    inserter.add_highres(int(client_id), filename, sid, rid, eid)
+
+def add_file(inserter, filename, expr_dict, cam_dict, illuminations, poses, expressions, highresolutions, verbose):
+  """Adds the file described by the given path stem (relative to the image
+     directory, without extension), if it is selected by the given flags."""
+  img_type = filename.split('/')[1]
+  if img_type == 'multiview':
+    add_mv_file(inserter, filename, expr_dict, cam_dict, illuminations, poses, expressions, verbose)
+  elif img_type == 'highres':
+    if highresolutions:
+      add_hr_file(inserter, filename, expr_dict, expressions, verbose)
+  else:
+    raise ValueError("The image type '%s' of file '%s' is unknown" % (img_type, filename))
+
+def list_dir(directory):
+  """Returns the names of all non-hidden entries of the given directory, in
+  sorted order, so that the files always receive the same ids"""
+  return sorted(e.name for e in os.scandir(directory) if nodot(e.name))
+
+def scan_mv_client(client_dir, stem, poses):
+  """Lists all multiview images of one client in one session"""
+  stems = []
+  # recording id
+  for recording in list_dir(client_dir):
+    recording_dir = os.path.join(client_dir, recording)
+    # camera name
+    for camera in list_dir(recording_dir):
+      # Check if it is the frontal camera 05_1
+      if ((not poses) and camera != '05_1'):
+        continue
+      # flashes/images
+      for image in list_dir(os.path.join(recording_dir, camera)):
+        basename, extension = os.path.splitext(image)
+        stems.append(os.path.join(stem, recording, camera, basename))
+  return stems
+
+def scan_hr_client(client_dir, stem):
+  """Lists all high-resolution images of one client in one session"""
+  return [os.path.join(stem, os.path.splitext(name)[0]) for name in list_dir(client_dir)]
+
+def scan_files(imagedir, poses, highresolutions, jobs=4, verbose=0, sessions=None):
+  """Walks the Multi-PIE image directory and yields the path stems of the
+  images, relative to ``imagedir`` and without extension.
+
+  The client directories are listed concurrently by ``jobs`` threads, while
+  the stems are yielded in the same order as in a sequential walk, i.e., in
+  sorted order of the session, client, recording, camera and image names.
+  Only a limited number of directory listings are kept ahead of the consumer.
+  If ``sessions`` is given, only these session directories are walked.
+  """
+
+  def tasks():
+    # session
+    for session_id in (list_dir(imagedir) if sessions is None else sessions):
+      if verbose: print("Adding files for session '%s'..." % (session_id))
+      se_dir = os.path.join(imagedir, session_id)
+
+      # multiview; client id
+      mv_dir = os.path.join(se_dir, 'multiview')
+      for client_id in list_dir(mv_dir):
+        yield scan_mv_client, os.path.join(mv_dir, client_id), os.path.join(session_id, 'multiview', client_id), poses
+
+      if highresolutions:
+        # highres; client id
+        hr_dir = os.path.join(se_dir, 'highres')
+        for client_id in list_dir(hr_dir):
+          yield scan_hr_client, os.path.join(hr_dir, client_id), os.path.join(session_id, 'highres', client_id)
+
+  jobs = max(jobs, 1)
+  with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+    pending = collections.deque()
+    for task in tasks():
+      pending.append(executor.submit(*task))
+      if len(pending) >= 4 * jobs:
+        for stem in pending.popleft().result():
+          yield stem
+    while pending:
+      for stem in pending.popleft().result():
+        yield stem
+
+def iter_manifest(manifest, imagedir):
+  """Yields the path stems listed in the given manifest file, which contains
+  one image path per line (as printed by the ``dumplist`` command). The paths
+  are either relative to the image directory, or absolute paths inside of it.
+  The manifest might be gzip-compressed (``.gz``). Empty lines and lines
+  starting with ``#`` are ignored, and file extensions are removed.
+
+  A ValueError with the line number is raised for paths that are not paths of
+  Multi-PIE images inside of the image directory."""
+
+  # the number of parts of the paths of each image type
+  lengths = {'multiview': 6, 'highres': 4}
+  opener = gzip.open if manifest.endswith('.gz') else open
+  with opener(manifest, 'rt') as f:
+    for number, line in enumerate(f, 1):
+      line = line.strip()
+      if not line or line[0] == '#':
+        continue
+      path = os.path.relpath(line, imagedir) if os.path.isabs(line) else os.path.normpath(line)
+      parts = path.replace(os.sep, '/').split('/')
+      if '..' in parts or len(parts) < 2 or lengths.get(parts[1]) != len(parts):
+        raise ValueError("Line %d of the manifest '%s' is not the path of a Multi-PIE image in '%s': '%s'" % (number, manifest, imagedir, line))
+      yield os.path.splitext('/'.join(parts))[0]
+
+def sorted_manifest(manifest, imagedir, batch_size=10000):
+  """Yields the path stems of :py:func:`iter_manifest` in the order of
+  :py:func:`scan_files`. The stems are sorted by SQLite in a temporary
+  database, so that the memory used does not depend on the size of the
+  manifest."""
+
+  import itertools
+  import shutil
+  import sqlite3
+  import tempfile
+
+  directory = tempfile.mkdtemp(prefix='multipie-manifest-')
+  connection = sqlite3.connect(os.path.join(directory, 'manifest.sql3'))
+  try:
+    # the parts of the stems after the image type: the client id, recording
+    # id, camera and image name (multiview), or the client id and image name
+    # (highres)
+    connection.execute('CREATE TABLE stem (session TEXT, highres INTEGER, p2 TEXT, p3 TEXT, p4 TEXT, p5 TEXT, stem TEXT)')
+    stems = iter_manifest(manifest, imagedir)
+    while True:
+      rows = []
+      for stem in itertools.islice(stems, batch_size):
+        parts = stem.split('/')
+        rows.append([parts[0], parts[1] != 'multiview'] + parts[2:] + [None] * (6 - len(parts)) + [stem])
+      if not rows:
+        break
+      connection.executemany('INSERT INTO stem VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    connection.commit()
+    for (stem,) in connection.execute('SELECT stem FROM stem ORDER BY session, highres, p2, p3, p4, p5'):
+      yield stem
+  finally:
+    connection.close()
+    shutil.rmtree(directory)
+
+def build_shard(task):
+  """Adds the files of a single session directory into a temporary database
+  (shard); this function is run by the worker processes of :py:func:`add_files`.
+  Returns the path of the shard."""
+
+  from bob.db.base.utils import create_engine_try_nolock
+
+  shard, imagedir, session_id, expr_dict, cam_dict, illuminations, poses, expressions, highresolutions, verbose, batch_size, jobs = task
+
+  engine = create_engine_try_nolock('sqlite', shard)
+  event.listen(engine, 'connect', bulk_load_pragmas)
+  Base.metadata.create_all(engine)
+  s = sessionmaker(bind=engine)()
+  inserter = FileInserter(s, batch_size)
+  for filename in scan_files(imagedir, poses, highresolutions, jobs, verbose, sessions=[session_id]):
+    add_file(inserter, filename, expr_dict, cam_dict, illuminations, poses, expressions, highresolutions, verbose)
+  inserter.flush()
+  s.commit()
+  s.close()
+  engine.dispose()
+  return shard
+
+def merge_shard(session, shard, verbose):
+  """Copies the files of the given shard into the database of the session,
+  where they receive new file ids in the order of the shard, continuing after
+  the largest id already stored. Files whose path is already stored are
+  skipped. The rows are copied by SQLite itself, after attaching the shard to
+  the connection of the session. Returns the number of copied files."""
+
+  if verbose: print("Merging files of shard '%s'..." % (shard))
+  session.commit()
+  connection = session.get_bind().connect()
+  try:
+    connection.execute('ATTACH DATABASE ? AS shard', (shard,))
+    with connection.begin():
+      offset = connection.execute('SELECT COALESCE(MAX(id), 0) FROM main.file').scalar()
+      # the new ids are the (consecutive) row ids of this table, plus the offset
+      connection.execute('CREATE TEMP TABLE shard_ids (new_id INTEGER PRIMARY KEY, old_id INTEGER)')
+      connection.execute('INSERT INTO temp.shard_ids (old_id) SELECT id FROM shard.file '
+                         'WHERE path NOT IN (SELECT path FROM main.file) ORDER BY id')
+      for table in (File.__table__, FileMultiview.__table__):
+        columns = [c.name for c in table.columns if c.name != 'id']
+        connection.execute('INSERT INTO main."%s" (id, %s) SELECT m.new_id + ?, %s FROM temp.shard_ids AS m JOIN shard."%s" AS t ON t.id = m.old_id ORDER BY m.new_id' % (
+            table.name, ', '.join('"%s"' % c for c in columns), ', '.join('t."%s"' % c for c in columns), table.name), (offset,))
+      count = connection.execute('SELECT COUNT(*) FROM temp.shard_ids').scalar()
+      connection.execute('DROP TABLE temp.shard_ids')
+    connection.execute('DETACH DATABASE shard')
+  finally:
+    connection.close()
+  return count
+
+def add_files(session, imagedir, illuminations, poses, expressions, highresolutions, verbose, batch_size=10000, jobs=4, manifest=None, processes=1):
+  """Add files (and clients) to the Multi-PIE database.
+
+  If a ``manifest`` file is given, the files are read from it instead of
+  walking the ``imagedir``. They are sorted in the order of the walk (see
+  :py:func:`sorted_manifest`), so that they receive the same ids as if the
+  ``imagedir`` was walked.
+
+  With several ``processes``, the session directories are ingested in
+  parallel, each into a temporary SQLite shard. The shards are merged in
+  order of their session names, so that the files receive the same ids as in
+  a sequential walk (see :py:func:`scan_files`). Clients, cameras and
+  expressions are only stored in the main database and their ids are shared
+  with all workers.
+  """
 
   # Start by creating the expressions and the cameras
   expr_dict = add_expressions(session, verbose)
   cam_dict = add_cameras(session, verbose)
+  inserter = FileInserter(session, batch_size)
+  merged = 0
 
-  # session
-  for session_id in filter(nodot, os.listdir(imagedir)):
-    if verbose: print("Adding files for session '%s'..." % (session_id))
-    se_dir = os.path.join(imagedir, session_id)
-
-    # multiview
-    mv_dir = os.path.join(se_dir, 'multiview')
-    # client id
-    for client_id in filter(nodot, os.listdir(mv_dir)):
-      client_dir = os.path.join(mv_dir, client_id)
-      # recording id
-      for recording_id in filter(nodot, os.listdir(client_dir)):
-        recording_dir = os.path.join(client_dir, recording_id)
-        # camera name
-        for camera_name in filter(nodot, os.listdir(recording_dir)):
-          # Check if it is the frontal camera 05_1
-          if ((not poses) and camera_name != '05_1'):
-            continue
-          camera_dir = os.path.join(recording_dir, camera_name)
-          # flashes/images
-          for filename in filter(nodot, os.listdir(camera_dir)):
-            basename, extension = os.path.splitext(filename)
-            add_mv_file(session, os.path.join( session_id, 'multiview', client_id, recording_id, camera_name, basename), session_id, client_id,
-                        recording_id, camera_name, expr_dict, cam_dict, expressions, verbose)
+  if manifest is None and processes > 1:
+    import multiprocessing
+    import shutil
+    import tempfile
 
-    if highresolutions:
-      # highres
-      hr_dir = os.path.join(se_dir, 'highres')
-      # client id
-      for client_id in filter(nodot, os.listdir(hr_dir)):
-        client_dir = os.path.join(hr_dir, client_id)
-        # flashes/images
-        for filename in filter(nodot, os.listdir(client_dir)):
-          basename, extension = os.path.splitext(filename)
-          add_hr_file(session, os.path.join( session_id, 'highres', client_id, basename), session_id, client_id, expr_dict, expressions, verbose)
+    tmpdir = tempfile.mkdtemp(prefix='multipie-shards-')
+    tasks = [(os.path.join(tmpdir, '%s.sql3' % session_id), imagedir, session_id, expr_dict, cam_dict,
+              illuminations, poses, expressions, highresolutions, verbose, batch_size, jobs)
+             for session_id in list_dir(imagedir)]
+    pool = multiprocessing.Pool(processes)
+    try:
+      for shard in pool.imap(build_shard, tasks):
+        merged += merge_shard(session, shard, verbose)
+        os.unlink(shard)
+      pool.close()
+    finally:
+      pool.terminate()
+      shutil.rmtree(tmpdir)
+  else:
+    if manifest is not None:
+      if verbose: print("Adding files listed in '%s'..." % (manifest))
+      filenames = sorted_manifest(manifest, imagedir, batch_size)
+    else:
+      filenames = scan_files(imagedir, poses, highresolutions, jobs, verbose)
+
+    for filename in filenames:
+      add_file(inserter, filename, expr_dict, cam_dict, illuminations, poses, expressions, highresolutions, verbose)
+
+  # writes the remaining rows
+  inserter.flush()
+  if verbose: print("Added %d new files" % (inserter.count + merged))
+
+def session_ordinal(sessions, session_id, recording_id):
+  """Returns the ordinal of the given session among the (first to fourth)
+  ``sessions`` of the client, or None if the client has no such session.
+
+  The first two recordings of session 4 count as two consecutive sessions of
+  the client, so the ordinal of the second one may be 5; its third recording
+  has no ordinal."""
+
+  if session_id not in sessions:
+    return None
+  k = sessions.index(session_id) + 1
+  if session_id != 4 or recording_id == 1:
+    return k
+  if recording_id == 2:
+    return k + 1
+  return None
+
+def shot_index(sessions, session_id, recording_id, shot_id):
+  """Returns the position of the given shot in the sequence of shots which the
+  world_nshots filter selects from: 19 shots for each of the first two
+  recordings of the first, second and third sessions of the client (where the
+  second recording of one session shares its 19 shots with the first recording
+  of the next one), followed by all shots of its fourth session. Returns None
+  if the shot is not in that sequence."""
+
+  first, second, third, fourth = sessions
+  if session_id == fourth:
+    m = 4
+  elif session_id in (first, second, third) and recording_id in (1, 2):
+    m = (first, second, third).index(session_id) + recording_id
+  else:
+    return None
+  if m < 4 and shot_id >= 19:
+    return None
+  return (m - 1) * 19 + shot_id
+
+def add_ordinals(session, verbose, batch_size=10000):
+  """Stores the session ordinal of the files and the shot index of the
+  multiview files, which answer the world_first ... world_fourth and
+  world_nshots queries. Only files that do not have them yet are updated.
+
+  The files are read and updated in batches of ``batch_size`` files, in order
+  of their ids, and every batch is committed. Files whose client is not in the
+  database are skipped."""
+
+  sessions = dict((c[0], tuple(c[1:])) for c in
+                  session.query(Client.id, Client.first_session, Client.second_session, Client.third_session, Client.fourth_session))
+  f = File.__table__
+  mv = FileMultiview.__table__
+  q = select([f.c.id, f.c.client_id, f.c.session_id, f.c.recording_id, f.c.session_ordinal, mv.c.id.label('multiview_id'), mv.c.shot_id, mv.c.shot_index]).\
+        select_from(f.outerjoin(mv)).\
+        where(or_(f.c.session_ordinal == None, and_(mv.c.id != None, mv.c.shot_index == None)))
+  update_ordinals = f.update().where(f.c.id == bindparam('_id')).values({'session_ordinal': bindparam('_value')})
+  update_indices = mv.update().where(mv.c.id == bindparam('_id')).values({'shot_index': bindparam('_value')})
+
+  last_id = 0
+  ordinal_count = index_count = 0
+  while True:
+    rows = session.execute(q.where(f.c.id > last_id).order_by(f.c.id).limit(batch_size)).fetchall()
+    if not rows:
+      break
+    last_id = rows[-1].id
+
+    ordinals = []
+    indices = []
+    for row in rows:
+      client_sessions = sessions.get(row.client_id)
+      if client_sessions is None:
+        continue
+      if row.session_ordinal is None:
+        ordinal = session_ordinal(client_sessions, row.session_id, row.recording_id)
+        if ordinal is not None:
+          ordinals.append({'_id': row.id, '_value': ordinal})
+      if row.multiview_id is not None and row.shot_index is None:
+        index = shot_index(client_sessions, row.session_id, row.recording_id, row.shot_id)
+        if index is not None:
+          indices.append({'_id': row.id, '_value': index})
+
+    if ordinals:
+      session.execute(update_ordinals, ordinals)
+    if indices:
+      session.execute(update_indices, indices)
+    session.commit()
+    ordinal_count += len(ordinals)
+    index_count += len(indices)
+  if verbose: print("Updated the session ordinals of %d files and the shot indices of %d files" % (ordinal_count, index_count))
 
 def add_protocols(session, illuminations, poses, expressions, highresolutions, verbose):
   """Adds protocols"""
@@ -352,22 +752,30 @@ def add_protocols(session, illuminations, poses, expressions, highresolutions, v
 
   # 2. ADDITIONS TO THE SQL DATABASE
   protocolPurpose_list = [('world', 'train'), ('dev', 'enroll'), ('dev', 'probe'), ('eval', 'enroll'), ('eval', 'probe')]
+  # Protocols and purposes that already exist are re-used; only the
+  # files that are not yet associated with a purpose are added to it
   for proto in protocol_definitions:
-    p = Protocol(proto)
-    # Add protocol
-    if verbose: print("Adding protocol %s..." % (proto))
-    session.add(p)
-    session.flush()
-    session.refresh(p)
+    p = session.query(Protocol).filter(Protocol.name == proto).first()
+    if p is None:
+      p = Protocol(proto)
+      # Add protocol
+      if verbose: print("Adding protocol %s..." % (proto))
+      session.add(p)
+      session.flush()
+      session.refresh(p)
+    elif verbose: print("Updating protocol %s..." % (proto))
 
     # Add protocol purposes
     for key in range(len(protocolPurpose_list)):
       purpose = protocolPurpose_list[key]
-      pu = ProtocolPurpose(p.id, purpose[0], purpose[1])
-      if verbose>1: print("  Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1]))
-      session.add(pu)
-      session.flush()
-      session.refresh(pu)
+      pu = session.query(ProtocolPurpose).filter(and_(ProtocolPurpose.protocol_id == p.id,
+            ProtocolPurpose.sgroup == purpose[0], ProtocolPurpose.purpose == purpose[1])).first()
+      if pu is None:
+        pu = ProtocolPurpose(p.id, purpose[0], purpose[1])
+        if verbose>1: print("  Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1]))
+        session.add(pu)
+        session.flush()
+        session.refresh(pu)
 
        # Add files attached with this protocol purpose
       client_group = ""
@@ -382,13 +790,14 @@ def add_protocols(session, illuminations, poses, expressions, highresolutions, v
       elif(key == 2 or key == 4):
         prop_list = protocol_definitions[proto][2]
 
-      # Adds 'protocol' files
+      # Adds 'protocol' files; the association rows are directly written
+      # with one INSERT ... SELECT statement, without loading any File
       for el in prop_list:
         sids = el[0] # list of session_ids
         rids = el[1] # list of recording_ids
         cams = el[2] # list of camera_ids
         shot_ids = el[3] # list of shot_ids
-        q = session.query(File).join(Client).join(FileMultiview).\
+        q = session.query(literal(pu.id), File.id).select_from(File).join(Client).join(FileMultiview).\
               filter(Client.sgroup == client_group)
         if sids:
           q = q.filter(File.session_id.in_(sids))
@@ -398,46 +807,250 @@ def add_protocols(session, illuminations, poses, expressions, highresolutions, v
           q = q.join(Camera).filter(Camera.name.in_(cams))
         if shot_ids:
           q = q.filter(FileMultiview.shot_id.in_(shot_ids))
+        q = q.filter(not_(File.id.in_(select([protocolPurpose_file_association.c.file_id]).\
+              where(protocolPurpose_file_association.c.protocolPurpose_id == pu.id))))
         q = q.order_by(File.id)
-        for k in q:
-          if verbose>1: print("    Adding protocol file '%s'..." % (k.path))
-          pu.files.append(k)
+        r = session.execute(protocolPurpose_file_association.insert().from_select(['protocolPurpose_id', 'file_id'], q.statement))
+        if verbose>1: print("    Added %d protocol files..." % (r.rowcount))
+
+    session.commit()
+    session.expunge_all()
+
+def peak_memory():
+  """Returns the peak resident memory of this process in bytes, or None if
+  it cannot be determined on this platform"""
+  try:
+    import resource
+  except ImportError:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is given in bytes on macOS, but in kilobytes elsewhere
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+class Profiler(object):
+  """Collects statistics about the phases of the database creation: the wall
+  time, the number of inserted or updated rows and the number of issued SQL
+  statements of each phase, and the peak resident memory of the process. The latter is
+  only reported for the whole run, since the operating system only gives the
+  highest value reached so far.
 
-def create_tables(args):
+  The statements are counted for all SQLAlchemy engines of this process while
+  the profiler is attached. Use it from Python like::
+
+    profiler = Profiler()
+    create(args, profiler)
+    stats = profiler.report()
+  """
+
+  def __init__(self):
+    self.phases = []
+    self.current = None
+    self.peak_memory = None
+
+  def attach(self):
+    """Starts counting the SQL statements"""
+    event.listen(Engine, 'after_cursor_execute', self.count)
+
+  def detach(self):
+    """Stops counting the SQL statements"""
+    event.remove(Engine, 'after_cursor_execute', self.count)
+
+  def count(self, connection, cursor, statement, parameters, context, executemany):
+    if self.current is None:
+      return
+    self.current['statements'] += 1
+    if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE') and cursor.rowcount > 0:
+      self.current['rows'] += cursor.rowcount
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    """Context manager that collects the statistics of the phase with the given name"""
+    self.current = {'name': name, 'statements': 0, 'rows': 0}
+    start = time.time()
+    try:
+      yield self.current
+    finally:
+      self.current['seconds'] = time.time() - start
+      self.peak_memory = peak_memory()
+      self.phases.append(self.current)
+      self.current = None
+
+  def report(self):
+    """Returns the collected statistics as a dictionary"""
+    return {
+      'phases': [dict(p) for p in self.phases],
+      'seconds': sum(p['seconds'] for p in self.phases),
+      'statements': sum(p['statements'] for p in self.phases),
+      'rows': sum(p['rows'] for p in self.phases),
+      'peak_memory': self.peak_memory,
+    }
+
+  def save(self, filename):
+    """Writes the collected statistics as JSON to the given file; ``-`` writes to the standard output"""
+    if filename == '-':
+      json.dump(self.report(), sys.stdout, indent=2)
+      sys.stdout.write('\n')
+    else:
+      with open(filename, 'w') as f:
+        json.dump(self.report(), f, indent=2)
+
+  def summary(self):
+    """Returns a human-readable summary of the collected statistics"""
+    lines = []
+    report = self.report()
+    for p in report['phases'] + [dict(report, name='total')]:
+      if p['name'] != 'total':
+        memory = ''
+      elif p['peak_memory'] is not None:
+        memory = '%.1f MB' % (p['peak_memory'] / 1024. / 1024.)
+      else:
+        memory = 'n/a'
+      lines.append(('%-14s %9.2f s %9d rows %8d statements %12s' % (p['name'], p['seconds'], p['rows'], p['statements'], memory)).rstrip())
+    return '\n'.join(lines)
+
+def bulk_load_pragmas(dbapi_connection, connection_record):
+  """Relaxes the durability settings of an SQLite connection, which is used
+  while building a database that is not visible to any reader yet. It is
+  registered as ``connect`` listener of the engine, since the settings only
+  hold for a single connection, and the engines of ``bob.db.base`` open a new
+  connection for every transaction."""
+  cursor = dbapi_connection.cursor()
+  cursor.execute('PRAGMA journal_mode = OFF')
+  cursor.execute('PRAGMA synchronous = OFF')
+  # negative values are in KiB, i.e., 256 MB of page cache
+  cursor.execute('PRAGMA cache_size = -262144')
+  cursor.execute('PRAGMA temp_store = MEMORY')
+  cursor.close()
+
+def create_tables(args, dbfile=None, engine=None):
   """Creates all necessary tables (only to be used at the first time)"""
 
   from bob.db.base.utils import create_engine_try_nolock
 
-  engine = create_engine_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
+  if dbfile is None: dbfile = args.files[0]
+  if engine is None: engine = create_engine_try_nolock(args.type, dbfile, echo=(args.verbose >= 2))
   Base.metadata.create_all(engine)
 
+  # create_all() does not add the columns and indexes of tables that already
+  # exist, e.g., when a database of an older version is extended with --incremental
+  inspector = inspect(engine)
+  for table in Base.metadata.sorted_tables:
+    existing = set(c['name'] for c in inspector.get_columns(table.name))
+    for column in table.columns:
+      if column.name not in existing:
+        if args.verbose: print("Adding column '%s.%s'..." % (table.name, column.name))
+        engine.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table.name, column.name, column.type.compile(engine.dialect)))
+  for table in Base.metadata.sorted_tables:
+    existing = set(i['name'] for i in inspector.get_indexes(table.name))
+    for index in table.indexes:
+      if index.name not in existing:
+        if args.verbose: print("Adding index '%s'..." % index.name)
+        index.create(engine)
+
+def finalize(args, dbfile, vacuum=True, engine=None):
+  """Updates the statistics of the query planner and compacts the database
+  (if ``vacuum`` is set)"""
+
+  from bob.db.base.utils import create_engine_try_nolock
+
+  if engine is None: engine = create_engine_try_nolock(args.type, dbfile, echo=(args.verbose >= 2))
+  # the statements are run through the engine, so that they are profiled
+  connection = engine.connect().execution_options(autocommit=True)
+  try:
+    connection.execute(text('ANALYZE'))
+    if vacuum:
+      connection.execute(text('VACUUM'))
+  finally:
+    connection.close()
+
 # Driver API
 # ==========
 
-def create(args):
+def create(args, profiler=None):
   """Creates or re-creates this database"""
 
-  from bob.db.base.utils import session_try_nolock
+  from bob.db.base.utils import create_engine_try_nolock
 
   dbfile = args.files[0]
 
-  if args.recreate:
-    if args.verbose and os.path.exists(dbfile):
-      print('unlinking %s...' % dbfile)
-    if os.path.exists(dbfile): os.unlink(dbfile)
+  if args.recreate and args.incremental:
+    raise ValueError("The options --recreate and --incremental cannot be used together")
+
+  if args.manifest is not None and args.processes > 1:
+    raise ValueError("The options --manifest and --processes cannot be used together")
+
+  if os.path.exists(dbfile) and not (args.recreate or args.incremental):
+    raise IOError("The database file '%s' already exists; use --recreate to erase it, or --incremental to only add the missing entries" % dbfile)
 
   if not os.path.exists(os.path.dirname(dbfile)):
     os.makedirs(os.path.dirname(dbfile))
 
-  # the real work...
-  create_tables(args)
-  s = session_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
-  add_clients(s, args.subjectlist, args.verbose)
-  add_subworlds(s, args.verbose)
-  add_files(s, args.imagedir, not args.noilluminations, args.poses, args.expressions, args.highresolutions, args.verbose)
-  add_protocols(s, not args.noilluminations, args.poses, args.expressions, args.highresolutions, args.verbose)
-  s.commit()
-  s.close()
+  if args.fast:
+    # the database is built in a temporary file in the same directory, which
+    # is moved over the database file when finished; readers of the current
+    # database file never see a partially written database
+    target = '%s.%d.tmp' % (dbfile, os.getpid())
+    if args.incremental and os.path.exists(dbfile):
+      import shutil
+      shutil.copyfile(dbfile, target)
+  else:
+    target = dbfile
+    if args.recreate:
+      if args.verbose and os.path.exists(dbfile):
+        print('unlinking %s...' % dbfile)
+      if os.path.exists(dbfile): os.unlink(dbfile)
+
+  engine = create_engine_try_nolock(args.type, target, echo=(args.verbose >= 2))
+  if args.fast:
+    event.listen(engine, 'connect', bulk_load_pragmas)
+
+  if profiler is None:
+    profiler = Profiler()
+  profiler.attach()
+
+  try:
+    # the real work...
+    with profiler.phase('create_tables'):
+      create_tables(args, target, engine)
+    s = sessionmaker(bind=engine)()
+    # each phase is committed on its own, and files are committed in chunks of
+    # --batch-size, so that an interrupted build can be resumed with --incremental
+    with profiler.phase('add_clients'):
+      add_clients(s, args.subjectlist, args.verbose)
+      s.commit()
+    with profiler.phase('add_subworlds'):
+      add_subworlds(s, args.verbose, args.subworlds)
+      s.commit()
+    with profiler.phase('add_files'):
+      add_files(s, args.imagedir, not args.noilluminations, args.poses, args.expressions, args.highresolutions, args.verbose, args.batch_size, args.jobs, args.manifest, args.processes)
+      s.commit()
+    with profiler.phase('add_ordinals'):
+      add_ordinals(s, args.verbose, args.batch_size)
+      s.commit()
+    with profiler.phase('add_protocols'):
+      add_protocols(s, not args.noilluminations, args.poses, args.expressions, args.highresolutions, args.verbose)
+      s.commit()
+    s.close()
+
+    # the statistics of the indexes are always updated, so that the query
+    # planner of the readers chooses the right indexes
+    with profiler.phase('finalize'):
+      finalize(args, target, vacuum=args.fast, engine=engine)
+    engine.dispose()
+    if args.fast:
+      if args.verbose: print('moving %s to %s...' % (target, dbfile))
+      os.replace(target, dbfile)
+  except:
+    engine.dispose()
+    if args.fast and os.path.exists(target): os.unlink(target)
+    raise
+  finally:
+    profiler.detach()
+
+  if args.verbose:
+    print(profiler.summary())
+  if args.report:
+    profiler.save(args.report)
 
 def add_command(subparsers):
   """Add specific subcommands that the action "create" can use"""
@@ -445,12 +1058,20 @@ def add_command(subparsers):
   parser = subparsers.add_parser('create', help=create.__doc__)
 
   parser.add_argument('-R', '--recreate', action='store_true', help="If set, I'll first erase the current database")
+  parser.add_argument('-F', '--fast', action='store_true', help="If set, the database is built in a temporary file with relaxed SQLite durability settings, which is finally compacted and atomically moved over the current database file")
+  parser.add_argument('--incremental', action='store_true', help="If set, the current database is kept and only the files (and protocol entries) that are not yet in there are added; this can also be used to resume an interrupted build")
   parser.add_argument('-v', '--verbose', action='count', help="Do SQL operations in a verbose way")
   parser.add_argument('-D', '--imagedir', metavar='DIR', default='/idiap/resource/database/Multi-Pie/data', help="Change the relative path to the directory containing the images of the Multi-PIE database.")
   parser.add_argument('--subjectlist', default='/idiap/resource/database/Multi-Pie/meta/subject_list.txt', help="Change the file containing the subject list of the Multi-PIE database.")
+  parser.add_argument('--subworlds', metavar='FILE', help="If given, additional subworlds are read from this file, which contains one subworld per line: its name followed by the ids of its clients")
   parser.add_argument('-I', '--noilluminations', action='store_true', help='If set, it will not add the illumination files (and corresponding protocols) in the database')
   parser.add_argument('-P', '--poses', action='store_true', help='If set, it will add the pose files (and corresponding protocols) in the database')
   parser.add_argument('-E', '--expressions', action='store_true', help='If set, it will add the expression files (and corresponding protocols) in the database')
   parser.add_argument('-H', '--highresolutions', action='store_true', help='If set, it will add the high-resolution files (and corresponding protocols) in the database')
+  parser.add_argument('-b', '--batch-size', type=int, default=10000, help='The number of file entries that are written and committed to the database at once')
+  parser.add_argument('-j', '--jobs', type=int, default=4, help='The number of threads that list the image directories in parallel')
+  parser.add_argument('-p', '--processes', type=int, default=1, help='If larger than 1, the session directories are ingested in parallel by this number of processes, each one writing into a temporary database that is merged afterwards')
+  parser.add_argument('--report', metavar='FILE', help="If given, the wall time, number of inserted or updated rows and number of SQL statements of each phase, and the peak memory of the process, are written as JSON to this file ('-' for the standard output)")
+  parser.add_argument('--manifest', metavar='FILE', help="If given, the files are read from this list of paths relative to the image directory (one per line, as printed by 'dumplist'; might be gzip-compressed) instead of walking the --imagedir; absolute paths must be inside of the --imagedir. This option cannot be combined with --processes")
 
   parser.set_defaults(func=create) #action
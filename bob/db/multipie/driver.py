@@ -32,7 +32,7 @@ def dumplist(args):
   from .query import Database
   db = Database()
 
-  r = db.objects(
+  r = db.iter_objects(
       protocol=args.protocol,
       purposes=args.purpose,
       model_ids=args.client,
@@ -117,6 +117,24 @@ def path(args):
 
   return 0
 
+def compile_annotations(args):
+  """Compiles the annotation files into a single annotation store"""
+
+  from .query import Database
+  from .annotations import STORE_NAME
+  db = Database(annotation_directory=args.directory, annotation_extension=args.extension)
+  directory = args.output or os.path.join(args.directory, STORE_NAME)
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  count = db.compile_annotations(directory, threads=args.threads)
+  output.write('%d annotated files were compiled into "%s"\n' % (count, directory))
+
+  return 0
+
 class Interface(BaseInterface):
 
   def name(self):
@@ -183,3 +201,12 @@ class Interface(BaseInterface):
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=path) #action
 
+    # adds the "compile-annotations" command
+    parser = subparsers.add_parser('compile-annotations', help=compile_annotations.__doc__)
+    parser.add_argument('-d', '--directory', required=True, help="the directory containing the annotation files.")
+    parser.add_argument('-e', '--extension', default='.pos', help="the extension of the annotation files.")
+    parser.add_argument('-o', '--output', help="the directory of the annotation store; by default, it is written to the sub-directory 'annotations.store' of the annotation directory, where it is found by the Database.")
+    parser.add_argument('-t', '--threads', type=int, default=8, help="the number of annotation files that are read at the same time.")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=compile_annotations) #action
+
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""An in-memory, columnar index of the Multi-PIE files, which answers the
+queries of :py:meth:`bob.db.multipie.Database.objects` with vectorized masks
+instead of SQL queries.
+"""
+
+import numpy
+
+from .models import *
+
+
+class FileIndex(object):
+  """Holds the file, client, camera, shot, session and protocol membership
+  information of the database in NumPy arrays, which are loaded once.
+
+  Keyword parameters:
+
+  database
+    The :py:class:`bob.db.multipie.Database` to load the index from.
+  """
+
+  def __init__(self, database):
+    # files, sorted by id; highres files have no shot and camera, and files
+    # without session ordinal or shot index are marked with -1
+    session_ordinal, shot_index = database._ordinal_columns()
+    rows = database.query(File.id, File.client_id, File.session_id, File.recording_id, File.expression_id, session_ordinal,
+                          FileMultiview.shot_id, FileMultiview.camera_id, shot_index).\
+        outerjoin(FileMultiview, FileMultiview.id == File.id).outerjoin(Client, Client.id == File.client_id).order_by(File.id).all()
+    columns = list(zip(*rows)) if rows else [()] * 9
+    self.ids = numpy.array(columns[0], dtype=numpy.int64)
+    self.client_ids = numpy.array(columns[1], dtype=numpy.int64)
+    self.session_ids = numpy.array(columns[2], dtype=numpy.int64)
+    self.recording_ids = numpy.array(columns[3], dtype=numpy.int64)
+    self.expression_ids = numpy.array(columns[4], dtype=numpy.int64)
+    self.session_ordinals = numpy.array([-1 if v is None else v for v in columns[5]], dtype=numpy.int64)
+    self.shot_ids = numpy.array([-1 if v is None else v for v in columns[6]], dtype=numpy.int64)
+    self.camera_ids = numpy.array([-1 if v is None else v for v in columns[7]], dtype=numpy.int64)
+    self.shot_indices = numpy.array([-1 if v is None else v for v in columns[8]], dtype=numpy.int64)
+    self.multiview = self.shot_ids >= 0
+
+    clients = [c[0] for c in database.query(Client.id)]
+    size = max(clients + [int(self.client_ids.max()) if len(self.client_ids) else 0]) + 1
+    self.client_count = size
+
+    # subworld memberships, indexed by client id; subworlds might have no clients
+    self.subworlds = dict((name, numpy.zeros(size, dtype=bool)) for (name,) in database.query(Subworld.name))
+    for name, client_id in database.query(Subworld.name, Client.id).join(Subworld.clients):
+      self.subworlds[name][client_id] = True
+
+    self.expressions = dict(database.query(Expression.name, Expression.id))
+    self.cameras = dict(database.query(Camera.name, Camera.id))
+
+    # protocol memberships: (protocol name, group, purpose) -> file positions
+    purposes = dict((pu_id, (name, sgroup, purpose)) for pu_id, name, sgroup, purpose in
+                    database.query(ProtocolPurpose.id, Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose).join(Protocol))
+    association = database.query(protocolPurpose_file_association.c.protocolPurpose_id, protocolPurpose_file_association.c.file_id).all()
+    columns = list(zip(*association)) if association else [(), ()]
+    purpose_ids = numpy.array(columns[0], dtype=numpy.int64)
+    positions = numpy.searchsorted(self.ids, numpy.array(columns[1], dtype=numpy.int64))
+    self.purposes = {}
+    for pu_id, key in purposes.items():
+      self.purposes[key] = positions[purpose_ids == pu_id]
+
+  def __len__(self):
+    return len(self.ids)
+
+  def _members(self, protocols, groups, purpose=None):
+    """Returns the mask of files belonging to any of the given protocols and groups, and to the given purpose (if any)"""
+    mask = numpy.zeros(len(self.ids), dtype=bool)
+    for (name, sgroup, p), positions in self.purposes.items():
+      if name in protocols and sgroup in groups and (purpose is None or p == purpose):
+        mask[positions] = True
+    return mask
+
+  def _in(self, values, names, lookup):
+    """Returns the mask of entries in ``values`` whose id is one of the ids of the given names"""
+    return numpy.isin(values, [lookup[n] for n in names if n in lookup])
+
+  def objects(self, protocol, purposes, model_ids, groups, classes, subworld=None, expressions=None, cameras=None,
+              world_sampling=1, world_noflash=False, world_first=False, world_second=False, world_third=False,
+              world_fourth=False, world_nshots=None, world_shots=None):
+    """Returns the ids of the files for the given query, sorted by client id,
+    session id, recording id and file id.
+
+    The parameters have the same meaning as in
+    :py:meth:`bob.db.multipie.Database.objects`, but must already be checked
+    for validity and expanded to lists (or an empty tuple for ``model_ids``).
+    """
+
+    session = self.session_ids
+    recording = self.recording_ids
+    shot = self.shot_ids
+
+    def common(mask):
+      if expressions:
+        mask &= self._in(self.expression_ids, expressions, self.expressions)
+      if cameras:
+        mask &= self.multiview & self._in(self.camera_ids, cameras, self.cameras)
+      return mask
+
+    retval = numpy.zeros(len(self.ids), dtype=bool)
+    if 'world' in groups:
+      mask = common(self._members(protocol, ('world',)))
+      if subworld:
+        clients = numpy.zeros(self.client_count, dtype=bool)
+        for name in subworld:
+          clients |= self.subworlds[name]
+        mask &= clients[self.client_ids]
+      if world_nshots or world_shots or (world_sampling != 1 and world_noflash == False) or world_noflash:
+        mask &= self.multiview
+      if world_nshots:
+        mask &= (self.shot_indices >= 0) & (self.shot_indices < world_nshots)
+      if world_shots:
+        mask &= numpy.isin(shot, world_shots)
+      if (world_sampling != 1 and world_noflash == False):
+        mask &= ((self.client_ids + shot) % world_sampling) == 0
+      if world_noflash:
+        mask &= shot == 0
+      for ordinal, selected in enumerate((world_first, world_second, world_third, world_fourth), 1):
+        if selected:
+          mask &= self.session_ordinals == ordinal
+      if model_ids:
+        mask &= numpy.isin(self.client_ids, model_ids)
+      retval |= mask
+
+    if ('dev' in groups or 'eval' in groups):
+      if 'enroll' in purposes:
+        mask = common(self._members(protocol, groups, 'enroll'))
+        if model_ids:
+          mask &= numpy.isin(self.client_ids, model_ids)
+        retval |= mask
+
+      if 'probe' in purposes:
+        probe = self._members(protocol, groups, 'probe')
+        if 'client' in classes:
+          mask = common(probe.copy())
+          if model_ids:
+            mask &= numpy.isin(self.client_ids, model_ids)
+          retval |= mask
+        if 'impostor' in classes:
+          mask = common(probe.copy())
+          if len(model_ids) == 1:
+            mask &= ~numpy.isin(self.client_ids, model_ids)
+          retval |= mask
+
+    positions = numpy.nonzero(retval)[0]
+    order = numpy.lexsort((self.ids[positions], recording[positions], session[positions], self.client_ids[positions]))
+    return self.ids[positions[order]]
@@ -19,11 +19,11 @@
 """Table models and functionality for the Multi-PIE database.
 """
 
-import os, numpy
+import os, numpy, collections
 import bob.db.base.utils
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, or_, and_, not_
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, Index, or_, and_, not_, case, null
 from bob.db.base.sqlalchemy_migration import Enum, relationship
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import backref, deferred
 from sqlalchemy.ext.declarative import declarative_base
 
 import bob.db.base
@@ -31,13 +31,20 @@ import bob.db.base
 
 Base = declarative_base()
 
+# The indexes below follow the joins and filters of Database.objects() and
+# Database.clients(); both directions of the association tables are indexed.
+
 subworld_client_association = Table('subworld_client_association', Base.metadata,
   Column('subworld_id', Integer, ForeignKey('subworld.id')),
-  Column('client_id',  Integer, ForeignKey('client.id')))
+  Column('client_id',  Integer, ForeignKey('client.id')),
+  Index('ix_subworld_client_association_subworld_client', 'subworld_id', 'client_id'),
+  Index('ix_subworld_client_association_client', 'client_id'))
 
 protocolPurpose_file_association = Table('protocolPurpose_file_association', Base.metadata,
   Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id')),
-  Column('file_id',  Integer, ForeignKey('file.id')))
+  Column('file_id',  Integer, ForeignKey('file.id')),
+  Index('ix_protocolPurpose_file_association_purpose_file', 'protocolPurpose_id', 'file_id'),
+  Index('ix_protocolPurpose_file_association_file', 'file_id'))
 
 class Client(Base):
   """Database clients, marked by an integer identifier and the group they belong to"""
@@ -96,11 +103,12 @@ class File(Base, bob.db.base.File):
   """Generic file container"""
 
   __tablename__ = 'file'
+  __table_args__ = (Index('ix_file_session_recording', 'session_id', 'recording_id'),)
 
   # Key identifier for the file
   id = Column(Integer, primary_key=True)
   # Key identifier of the client associated with this file
-  client_id = Column(Integer, ForeignKey('client.id')) # for SQL
+  client_id = Column(Integer, ForeignKey('client.id'), index=True) # for SQL
   # Unique path to this file inside the database
   path = Column(String(100), unique=True)
   # Identifier of the session
@@ -112,6 +120,11 @@ class File(Base, bob.db.base.File):
   img_type = Column(Enum(*imagetype_choices))
   # Identifier of the expression
   expression_id = Column(Integer, ForeignKey('expression.id'))
+  # Ordinal of the session (and recording) among the sessions of the client,
+  # which is used to select the first, second, ... session of the client; it
+  # is not loaded with the File, since older databases do not have it (see
+  # session_ordinal_expression())
+  session_ordinal = deferred(Column(Integer, index=True))
 
   # for Python
   client = relationship("Client", backref=backref("files", order_by=id))
@@ -134,9 +147,14 @@ class FileMultiview(Base):
   # Key identifier for the file multiview
   id = Column(Integer, ForeignKey('file.id'), primary_key=True) # for SQL
   # Identifier of the shot
-  shot_id = Column(Integer)
+  shot_id = Column(Integer, index=True)
   # Identifier of the camera
-  camera_id = Column(Integer, ForeignKey('camera.id'))
+  camera_id = Column(Integer, ForeignKey('camera.id'), index=True)
+  # Position of the shot in the shots of all sessions of the client, which is
+  # used to select the n first shots of the client; it is not loaded with the
+  # FileMultiview, since older databases do not have it (see
+  # shot_index_expression())
+  shot_index = deferred(Column(Integer, index=True))
 
   # for Python
   file = relationship("File", uselist=False, backref=backref("file_multiview", uselist=False, order_by=id))
@@ -149,6 +167,44 @@ class FileMultiview(Base):
   def __repr__(self):
     return "FileMultiview('%s')" % (self.file.path)
 
+def session_ordinal_expression():
+  """Returns an SQL expression that computes File.session_ordinal from the
+  sessions of the client, for databases that were created without this column.
+  The queries using it must join the Client of the File."""
+
+  position = case([(File.session_id == Client.first_session, 1),
+                   (File.session_id == Client.second_session, 2),
+                   (File.session_id == Client.third_session, 3),
+                   (File.session_id == Client.fourth_session, 4)], else_=null())
+  # the first two recordings of session 4 count as two consecutive sessions
+  return case([(or_(File.session_id != 4, File.recording_id == 1), position),
+               (File.recording_id == 2, position + 1)], else_=null())
+
+def shot_index_expression():
+  """Returns an SQL expression that computes FileMultiview.shot_index from the
+  sessions of the client, for databases that were created without this column.
+  The queries using it must join the Client and the FileMultiview of the File."""
+
+  session, recording = File.session_id, File.recording_id
+  # the position of the recording in the sequence of recordings, starting at 1
+  position = case([(session == Client.fourth_session, 4),
+                   (and_(session == Client.first_session, recording.in_((1, 2))), recording),
+                   (and_(session == Client.second_session, recording.in_((1, 2))), recording + 1),
+                   (and_(session == Client.third_session, recording.in_((1, 2))), recording + 2)], else_=null())
+  return case([(and_(position < 4, FileMultiview.shot_id >= 19), null())],
+              else_=(position - 1) * 19 + FileMultiview.shot_id)
+
+class FileRecord(collections.namedtuple('FileRecord', ['id', 'client_id', 'path', 'session_id', 'recording_id', 'shot_id', 'camera'])):
+  """A lightweight, immutable copy of the main information of a File, as
+  returned by Database.objects(lite=True). The shot_id and camera (name) are
+  None for highres files."""
+
+  __slots__ = ()
+
+  def make_path(self, directory=None, extension=None):
+    """Wraps the current path so that a complete path is formed"""
+    return str(os.path.join(directory or '', self.path + (extension or '')))
+
 class Expression(Base):
   """Multi-PIE expressions"""
 
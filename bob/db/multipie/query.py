@@ -21,9 +21,14 @@ Multi-PIE database in the most obvious ways.
 """
 
 import os
+import numpy
 from bob.db.base import utils
+from sqlalchemy import union, inspect
+from sqlalchemy.orm import configure_mappers, joinedload
 from .models import *
 from .driver import Interface
+from .cache import LRUCache, ResultStore, normalize
+from .annotations import read_annotation_file, read_annotation_files, write_annotation_store, annotation_array, files_digest, AnnotationStore, STORE_NAME
 import bob.db.base
 
 SQLITE_FILE = Interface().files()[0]
@@ -34,9 +39,41 @@ class Database(bob.db.base.SQLiteDatabase):
 
   It provides many different ways to probe for the characteristics of the data
   and for the data itself inside the database.
+
+  If ``use_index`` is set, :py:meth:`objects` is answered from an in-memory
+  index of the files (see :py:meth:`file_index`), which is loaded at the
+  first call, instead of querying the database each time.
+
+  The names of the protocols, subworlds, expressions and cameras, the ids
+  of the clients and of the protocol purposes, which are required to check and
+  run the queries, are read once and cached. They are read again (and the connection is re-opened) when
+  the modification time, the size or the inode of the database file changes,
+  e.g., after it was re-created.
+
+  If ``query_cache_size`` is larger than 0, the results of up to that many
+  different :py:meth:`objects` and :py:meth:`clients` queries are kept (see
+  :py:meth:`query_cache_info`), until the database file changes.
+
+  If a ``cache_directory`` is given, the ids of the files returned by
+  :py:meth:`objects` are also stored in that directory, per content of the
+  database file. Other processes using the same directory then get the same
+  file lists without querying the database (see :py:meth:`object_ids`).
+
+  If the annotation files were compiled into an annotation store (see
+  :py:meth:`compile_annotations`), :py:meth:`annotations` looks the
+  annotations up in the store instead of reading the annotation files. The
+  store is searched in the ``annotation_store`` directory, or by default in
+  the sub-directory ``annotations.store`` of the ``annotation_directory``.
+  It is only used if it was compiled for the same files and annotation
+  extension.
+
+  If ``annotation_cache_size`` is larger than 0, the annotations read from up
+  to that many annotation files are kept (see :py:meth:`annotation_cache_info`).
+  They are read again when the modification time of the annotation file
+  changes.
   """
 
-  def __init__(self, original_directory=None, original_extension='.png', annotation_directory=None, annotation_extension='.pos'):
+  def __init__(self, original_directory=None, original_extension='.png', annotation_directory=None, annotation_extension='.pos', use_index=False, query_cache_size=0, cache_directory=None, annotation_store=None, annotation_cache_size=0):
     # NOTE: The default original extension '.png' is only valid for the
     # "multiview" data, but not for the "highres" images, which are stored as
     # '.jpg'
@@ -46,6 +83,152 @@ class Database(bob.db.base.SQLiteDatabase):
 
     self.annotation_directory = annotation_directory
     self.annotation_extension = annotation_extension
+    self.annotation_store = annotation_store
+
+    self.use_index = use_index
+    self._index = None
+    self._metadata_cache = None
+    self._query_cache = LRUCache(query_cache_size)
+    self._annotation_cache = LRUCache(annotation_cache_size)
+    self._result_store = ResultStore(cache_directory) if cache_directory is not None else None
+    self._database_hash = None
+    self._store = False
+    self._signature = self._file_signature()
+
+  def _file_signature(self):
+    """Returns the modification time, size and inode of the database file, or
+    None if it does not exist"""
+
+    try:
+      stat = os.stat(self.m_sqlite_file)
+    except OSError:
+      return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+  def _check_database(self):
+    """Drops everything that was cached from the database file and re-opens the
+    connection if the file has changed since it was opened"""
+
+    signature = self._file_signature()
+    if signature == self._signature:
+      return
+    if self.m_session is not None:
+      self.m_session.close()
+      self.m_session.bind.dispose()
+    self.m_session = utils.session_try_readonly('sqlite', self.m_sqlite_file) if signature is not None else None
+    self._signature = signature
+    self._metadata_cache = None
+    self._query_cache.clear()
+    self._annotation_cache.clear()
+    self._database_hash = None
+    self._index = None
+    self._store = False
+
+  def query_cache_info(self):
+    """Returns the number of hits and misses, the number of entries and the
+    capacity of the cache of query results"""
+
+    return self._query_cache.info()
+
+  def clear_query_cache(self):
+    """Drops all cached query results"""
+
+    self._query_cache.clear()
+
+  def annotation_cache_info(self):
+    """Returns the number of hits and misses, the number of entries and the
+    capacity of the cache of annotations"""
+
+    return self._annotation_cache.info()
+
+  def clear_annotation_cache(self):
+    """Drops all cached annotations"""
+
+    self._annotation_cache.clear()
+
+  def _metadata(self):
+    """Returns the cached protocol, subworld, expression and camera names and
+    client ids of the database, which are read at the first call"""
+
+    self._check_database()
+    if self._metadata_cache is None:
+      metadata = {
+        'protocols': [str(p.name) for p in self.query(Protocol)],
+        'subworlds': [str(s.name) for s in self.query(Subworld)],
+        'expressions': [str(e.name) for e in self.query(Expression)],
+        'cameras': [str(c.name) for c in self.query(Camera)],
+        'client_ids': set(c[0] for c in self.query(Client.id)),
+        'purposes': dict(((str(name), str(sgroup), str(purpose)), i) for i, name, sgroup, purpose in
+                         self.query(ProtocolPurpose.id, Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose).join(Protocol)),
+        'ordinals': self._has_ordinals(),
+      }
+      for key in ('protocols', 'subworlds', 'expressions', 'cameras'):
+        metadata[key + '_set'] = set(metadata[key])
+      self._metadata_cache = metadata
+    return self._metadata_cache
+
+  def _has_ordinals(self):
+    """Tells if the database stores the session ordinals and shot indices,
+    which older databases do not"""
+
+    inspector = inspect(self.m_session.bind)
+    return 'session_ordinal' in [c['name'] for c in inspector.get_columns(File.__tablename__)] and \
+        'shot_index' in [c['name'] for c in inspector.get_columns(FileMultiview.__tablename__)]
+
+  def _ordinal_columns(self):
+    """Returns the session ordinal of the files and the shot index of the
+    multiview files, as stored columns or, for databases created without
+    them, as expressions that compute them from the sessions of the client"""
+
+    if self._metadata()['ordinals']:
+      return File.session_ordinal, FileMultiview.shot_index
+    return session_ordinal_expression(), shot_index_expression()
+
+  def file_index(self):
+    """Returns the in-memory :py:class:`bob.db.multipie.FileIndex` of
+    this database, which is loaded at the first call"""
+
+    self._check_database()
+    if self._index is None:
+      from .index import FileIndex
+      self._index = FileIndex(self)
+    return self._index
+
+  def _files_from_ids(self, ids, eager=False):
+    """Returns the File objects with the given ids, in the same order. Their
+    relationships are loaded by the same queries if ``eager`` is set."""
+
+    ids = [int(i) for i in ids]
+    files = {}
+    # SQLite allows 999 parameters per query
+    for k in range(0, len(ids), 900):
+      q = self.query(File).filter(File.id.in_(ids[k:k+900]))
+      if eager:
+        q = q.options(*self._eager_options())
+      for f in q:
+        files[f.id] = f
+    return [files[i] for i in ids]
+
+  def _eager_options(self):
+    """Returns the query options that load the client, expression, multiview
+    information and camera of the files in the same query"""
+
+    # the backrefs (e.g. File.file_multiview) only exist once the mappers are configured
+    configure_mappers()
+    return [joinedload(File.client), joinedload(File.expression),
+            joinedload(File.file_multiview).joinedload(FileMultiview.camera)]
+
+  def _records_from_ids(self, ids):
+    """Returns the :py:class:`FileRecord` of the files with the given ids, in
+    the same order"""
+
+    ids = [int(i) for i in ids]
+    records = {}
+    # SQLite allows 999 parameters per query
+    for k in range(0, len(ids), 900):
+      for row in self._record_query().filter(File.id.in_(ids[k:k+900])):
+        records[row[0]] = FileRecord(*row)
+    return [records[i] for i in ids]
 
   def groups(self, protocol=None):
     """Returns the names of all registered groups"""
@@ -66,14 +249,12 @@ class Database(bob.db.base.SQLiteDatabase):
   def has_subworld(self, name):
     """Tells if a certain subworld is available"""
 
-    return self.query(Subworld).filter(Subworld.name == name).count() != 0
+    return name in self._metadata()['subworlds_set']
 
   def subworld_names(self):
     """Returns all registered subworld names"""
 
-    l = self.subworlds()
-    retval = [str(k.name) for k in l]
-    return retval
+    return list(self._metadata()['subworlds'])
 
   def expressions(self):
     """Returns the list of expressions"""
@@ -83,14 +264,12 @@ class Database(bob.db.base.SQLiteDatabase):
   def has_expression(self, name):
     """Tells if a certain expression is available"""
 
-    return self.query(Expression).filter(Expression.name == name).count() != 0
+    return name in self._metadata()['expressions_set']
 
   def expression_names(self):
     """Returns all registered expression names"""
 
-    l = self.expressions()
-    retval = [str(k.name) for k in l]
-    return retval
+    return list(self._metadata()['expressions'])
 
   def cameras(self):
     """Returns the list of cameras"""
@@ -100,12 +279,12 @@ class Database(bob.db.base.SQLiteDatabase):
   def has_camera(self, name):
     """Tells if a certain camera is available"""
 
-    return self.query(Camera).filter(Camera.name == name).count() != 0
+    return name in self._metadata()['cameras_set']
 
   def camera_names(self):
     """Returns all registered camera names"""
 
-    return [str(c.name) for c in self.cameras()]
+    return list(self._metadata()['cameras'])
 
   def clients(self, protocol=None, groups=None, subworld=None, genders=None, birthyears=None):
     """Returns a set of Clients for the specific query by the user.
@@ -145,6 +324,16 @@ class Database(bob.db.base.SQLiteDatabase):
     birthyears = self.check_parameters_for_validity(
         birthyears, 'birthyear', VALID_BIRTHYEARS)
 
+    key = ('clients', normalize(protocol), normalize(groups), normalize(subworld), normalize(genders), normalize(birthyears))
+    retval = self._query_cache.get(key)
+    if retval is None:
+      retval = self._clients(protocol, groups, subworld, genders, birthyears)
+      self._query_cache.put(key, retval)
+    return list(retval)
+
+  def _clients(self, protocol, groups, subworld, genders, birthyears):
+    """Queries the clients for the already checked parameters of :py:meth:`clients`"""
+
     # List of the clients
     retval = []
     # World data
@@ -169,9 +358,14 @@ class Database(bob.db.base.SQLiteDatabase):
     return retval
 
   def has_client_id(self, id):
-    """Returns True if we have a client with a certain integer identifier"""
+    """Returns True if we have a client with a certain integer identifier,
+    which might also be given as a string, e.g., ``'1'``"""
 
-    return self.query(Client).filter(Client.id == id).count() != 0
+    try:
+      id = int(id)
+    except (TypeError, ValueError):
+      return False
+    return id in self._metadata()['client_ids']
 
   def client(self, id):
     """Returns the Client object in the database given a certain id. Raises
@@ -310,7 +504,7 @@ class Database(bob.db.base.SQLiteDatabase):
   def objects(self, protocol=None, purposes=None, model_ids=None, groups=None,
               classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
               world_noflash=False, world_first=False, world_second=False, world_third=False,
-              world_fourth=False, world_nshots=None, world_shots=None):
+              world_fourth=False, world_nshots=None, world_shots=None, lite=False, eager=False):
     """Returns a set of Files for the specific query by the user.
 
     Keyword Parameters:
@@ -390,9 +584,175 @@ class Database(bob.db.base.SQLiteDatabase):
       Only uses data from the fourth recorded session of each user of the world
       dataset.
 
-    Returns: A set of Files with the given properties.
+    lite
+      If set, returns light-weight :py:class:`bob.db.multipie.FileRecord`
+      tuples, which are read directly from the query results, instead of File
+      objects.
+
+    eager
+      If set, the client, expression, multiview information and camera of the
+      returned Files are loaded by the same query, so that accessing them does
+      not run one more query per file. It has no effect if ``lite`` is set.
+
+    Returns: A list of the Files with the given properties, sorted by client
+    id, session id, recording id and file id.
+    """
+
+    path = None
+    if self._result_store is not None:
+      path, ids = self._stored_object_ids(
+          protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+          world_sampling, world_noflash, world_first, world_second, world_third,
+          world_fourth, world_nshots, world_shots)
+      if ids is not None:
+        return self._records_from_ids(ids) if lite else self._files_from_ids(ids, eager)
+
+    files = self._select_objects(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                                 world_sampling, world_noflash, world_first, world_second, world_third,
+                                 world_fourth, world_nshots, world_shots, lite, eager)
+    if path is not None:
+      self._result_store.save(path, numpy.array([f.id for f in files], dtype=numpy.int64))
+    return files
+
+  def iter_objects(self, batch_size=1000, protocol=None, purposes=None, model_ids=None, groups=None,
+                   classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
+                   world_noflash=False, world_first=False, world_second=False, world_third=False,
+                   world_fourth=False, world_nshots=None, world_shots=None, lite=False, eager=False):
+    """Iterates over the Files for the specific query by the user, in the same
+    order as :py:meth:`objects` returns them. The files are fetched from the
+    database in batches, and are not kept, so that the memory used does not
+    depend on the number of files. The query cache is not used.
+
+    Keyword Parameters:
+
+    batch_size
+      The number of files that are fetched from the database at once.
+
+    The other keyword parameters are the same as for :py:meth:`objects`.
     """
 
+    # the parameters are checked here, and not when the iteration starts
+    protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras = \
+        self._check_objects_parameters(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras)
+    return self._iter_objects(batch_size, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                              world_sampling, world_noflash, world_first, world_second, world_third,
+                              world_fourth, world_nshots, world_shots, lite, eager)
+
+  def _iter_objects(self, batch_size, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                    world_sampling, world_noflash, world_first, world_second, world_third,
+                    world_fourth, world_nshots, world_shots, lite, eager):
+    """Yields the files for the already checked parameters of :py:meth:`iter_objects`"""
+
+    if self.use_index:
+      ids = [int(i) for i in self.file_index().objects(
+          protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+          world_sampling, world_noflash, world_first, world_second, world_third,
+          world_fourth, world_nshots, world_shots)]
+      # SQLite allows 999 parameters per query
+      step = min(batch_size, 900)
+      for k in range(0, len(ids), step):
+        if lite:
+          files = self._records_from_ids(ids[k:k+step])
+        else:
+          q = self.query(File).filter(File.id.in_(ids[k:k+step]))
+          if eager:
+            q = q.options(*self._eager_options())
+          files = dict((f.id, f) for f in q)
+          files = [files[i] for i in ids[k:k+step]]
+        for f in files:
+          yield f
+      return
+
+    q = self._objects_query(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                            world_sampling, world_noflash, world_first, world_second, world_third,
+                            world_fourth, world_nshots, world_shots, lite, eager)
+    if q is not None:
+      for f in q.yield_per(batch_size):
+        yield FileRecord(*f) if lite else f
+
+  def object_ids(self, protocol=None, purposes=None, model_ids=None, groups=None,
+                 classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
+                 world_noflash=False, world_first=False, world_second=False, world_third=False,
+                 world_fourth=False, world_nshots=None, world_shots=None):
+    """Returns the ids of the Files for the specific query by the user, as a
+    NumPy array. The keyword parameters are the same as for :py:meth:`objects`.
+
+    If the database was opened with a ``cache_directory``, the ids are read
+    from there if another call (possibly by another process) already stored
+    them for the same database file, without querying the database.
+    """
+
+    path = None
+    if self._result_store is not None:
+      path, ids = self._stored_object_ids(
+          protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+          world_sampling, world_noflash, world_first, world_second, world_third,
+          world_fourth, world_nshots, world_shots)
+      if ids is not None:
+        return ids
+
+    files = self._select_objects(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                                 world_sampling, world_noflash, world_first, world_second, world_third,
+                                 world_fourth, world_nshots, world_shots)
+    ids = numpy.array([f.id for f in files], dtype=numpy.int64)
+    if path is not None:
+      self._result_store.save(path, ids)
+    return ids
+
+  def _stored_object_ids(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                         world_sampling, world_noflash, world_first, world_second, world_third,
+                         world_fourth, world_nshots, world_shots):
+    """Checks the parameters of :py:meth:`objects` and returns the path of
+    their results in the result store, and the ids stored there, or None if
+    they were not stored yet"""
+
+    self._check_database()
+    if self._database_hash is None:
+      self._database_hash = self._result_store.database_hash(self.m_sqlite_file)
+    protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras = \
+        self._check_objects_parameters(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras)
+    key = self._objects_key(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                            world_sampling, world_noflash, world_first, world_second, world_third,
+                            world_fourth, world_nshots, world_shots)
+    path = self._result_store.path(self._database_hash, key)
+    return path, self._result_store.load(path)
+
+  def _select_objects(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                      world_sampling, world_noflash, world_first, world_second, world_third,
+                      world_fourth, world_nshots, world_shots, lite=False, eager=False):
+    """Checks the parameters of :py:meth:`objects` and returns the files, from
+    the query cache if possible"""
+
+    protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras = \
+        self._check_objects_parameters(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras)
+
+    key = self._objects_key(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                            world_sampling, world_noflash, world_first, world_second, world_third,
+                            world_fourth, world_nshots, world_shots) + (bool(lite), bool(eager) and not lite)
+    retval = self._query_cache.get(key)
+    if retval is None:
+      retval = self._objects(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                             world_sampling, world_noflash, world_first, world_second, world_third,
+                             world_fourth, world_nshots, world_shots, lite, eager)
+      self._query_cache.put(key, retval)
+    return list(retval)
+
+  def _objects_key(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                   world_sampling, world_noflash, world_first, world_second, world_third,
+                   world_fourth, world_nshots, world_shots):
+    """Returns the key of the results of :py:meth:`objects` in the caches, for
+    parameters that were checked and expanded by
+    :py:meth:`_check_objects_parameters`; it is the same for all spellings of
+    the same query"""
+
+    return ('objects', normalize(protocol), normalize(purposes), normalize(model_ids), normalize(groups), normalize(classes),
+            normalize(subworld or None), normalize(expressions or None), normalize(cameras or None), world_sampling,
+            bool(world_noflash), bool(world_first), bool(world_second), bool(world_third), bool(world_fourth),
+            world_nshots or None, normalize(world_shots or None))
+
+  def _check_objects_parameters(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras):
+    """Checks the parameters of :py:meth:`objects` and expands them to lists"""
+
     protocol = self.check_parameters_for_validity(
         protocol, 'protocol', self.protocol_names())
     purposes = self.check_parameters_for_validity(
@@ -410,18 +770,90 @@ class Database(bob.db.base.SQLiteDatabase):
       cameras = self.check_parameters_for_validity(
           cameras, 'camera', self.camera_names())
 
-    import collections
+    import collections.abc
     if(model_ids is None):
       model_ids = ()
-    elif(not isinstance(model_ids, collections.Iterable)):
+    elif(not isinstance(model_ids, collections.abc.Iterable)):
       model_ids = (model_ids,)
 
-    # Now query the database
-    retval = []
+    return protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras
+
+  def _objects(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+               world_sampling, world_noflash, world_first, world_second, world_third,
+               world_fourth, world_nshots, world_shots, lite=False, eager=False):
+    """Queries the files for the already checked parameters of :py:meth:`objects`"""
+
+    if self.use_index:
+      ids = self.file_index().objects(
+          protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+          world_sampling, world_noflash, world_first, world_second, world_third,
+          world_fourth, world_nshots, world_shots)
+      return self._records_from_ids(ids) if lite else self._files_from_ids(ids, eager)
+
+    q = self._objects_query(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                            world_sampling, world_noflash, world_first, world_second, world_third,
+                            world_fourth, world_nshots, world_shots, lite, eager)
+    if q is None:
+      return []
+    return [FileRecord(*row) for row in q] if lite else list(q)
+
+  def _objects_query(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                     world_sampling, world_noflash, world_first, world_second, world_third,
+                     world_fourth, world_nshots, world_shots, lite=False, eager=False):
+    """Returns a single query for the files of the already checked parameters of
+    :py:meth:`objects`. The files selected for the world, enroll and probe data
+    are combined with a UNION, which also removes duplicates, and sorted by
+    client, session, recording and file id. If ``lite`` is set, the query
+    returns the fields of :py:class:`FileRecord` instead of File objects; if
+    ``eager`` is set, the relationships of the File objects are loaded as well.
+    Returns None if no file can be selected."""
+
+    queries = self._objects_id_queries(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                                       world_sampling, world_noflash, world_first, world_second, world_third,
+                                       world_fourth, world_nshots, world_shots)
+    if not queries:
+      return None
+    if len(queries) == 1:
+      ids = queries[0].statement
+    else:
+      ids = union(*[q.statement for q in queries])
+    if lite:
+      q = self._record_query()
+    elif eager:
+      q = self.query(File).options(*self._eager_options())
+    else:
+      q = self.query(File)
+    return q.filter(File.id.in_(ids)).\
+        order_by(File.client_id, File.session_id, File.recording_id, File.id)
+
+  def _record_query(self):
+    """Returns a query for the fields of :py:class:`FileRecord`"""
+
+    return self.query(File.id, File.client_id, File.path, File.session_id, File.recording_id, FileMultiview.shot_id, Camera.name).\
+        outerjoin(FileMultiview, FileMultiview.id == File.id).outerjoin(Camera, Camera.id == FileMultiview.camera_id)
+
+  def _members_query(self, protocol, groups, purpose=None):
+    """Returns a query for the ids of the files (joined with their clients)
+    that belong to the given protocols and groups, and to the given purpose (if
+    any). The protocol purposes are taken from the cached metadata, so that
+    SQLite only reads the members of these protocol purposes."""
+
+    metadata = self._metadata()
+    ids = sorted(i for (p, g, pu), i in metadata['purposes'].items()
+                 if p in protocol and g in groups and (purpose is None or pu == purpose))
+    return self.query(File.id).join(Client).join(protocolPurpose_file_association).\
+        filter(protocolPurpose_file_association.c.protocolPurpose_id.in_(ids))
+
+  def _objects_id_queries(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+                          world_sampling, world_noflash, world_first, world_second, world_third,
+                          world_fourth, world_nshots, world_shots):
+    """Returns the queries for the ids of the world, enroll, probe client and
+    probe impostor files selected by the parameters of :py:meth:`objects`"""
+
+    queries = []
     if 'world' in groups:
-      q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-          filter(and_(Protocol.name.in_(protocol),
-                      ProtocolPurpose.sgroup == 'world'))
+      session_ordinal, shot_index = self._ordinal_columns()
+      q = self._members_query(protocol, ('world',))
       if subworld:
         q = q.join((Subworld, Client.subworld)).filter(
             Subworld.name.in_(subworld))
@@ -432,31 +864,8 @@ class Database(bob.db.base.SQLiteDatabase):
       if cameras:
         q = q.join(Camera).filter(Camera.name.in_(cameras))
       if world_nshots:
-        max1 = 19
-        max2 = 19
-        max3 = 19
-        max4 = 19
-        if world_nshots < 19:
-          max1 = world_nshots
-          max2 = 0
-          max3 = 0
-          max4 = 0
-        elif world_nshots < 38:
-          max2 = world_nshots - 19
-          max3 = 0
-          max4 = 0
-        elif world_nshots < 57:
-          max3 = world_nshots - 38
-          max4 = 0
-        else:
-          max4 = world_nshots - 57
-        q = q.filter(or_(and_(File.session_id == Client.first_session, or_(and_(File.recording_id == 1, FileMultiview.shot_id < max1),
-                                                                           and_(File.recording_id == 2, FileMultiview.shot_id < max2))),
-                         and_(File.session_id == Client.second_session, or_(and_(File.recording_id == 1, FileMultiview.shot_id < max2),
-                                                                            and_(File.recording_id == 2, FileMultiview.shot_id < max3))),
-                         and_(File.session_id == Client.third_session, or_(and_(File.recording_id == 1, FileMultiview.shot_id < max3),
-                                                                           and_(File.recording_id == 2, FileMultiview.shot_id < max4))),
-                         and_(File.session_id == Client.fourth_session, FileMultiview.shot_id < max4)))
+        # the shot index counts the shots of the sessions of the client in turn
+        q = q.filter(shot_index < world_nshots)
       if world_shots:
         q = q.filter(FileMultiview.shot_id.in_(world_shots))
       if (world_sampling != 1 and world_noflash == False):
@@ -465,31 +874,20 @@ class Database(bob.db.base.SQLiteDatabase):
       if world_noflash:
         q = q.filter(FileMultiview.shot_id == 0)
       if world_first:
-        q = q.filter(and_(File.session_id == Client.first_session, or_(Client.first_session != 4,
-                                                                       and_(Client.first_session == 4, File.recording_id == 1))))
+        q = q.filter(session_ordinal == 1)
       if world_second:
-        q = q.filter(or_(and_(Client.second_session != 4, File.session_id == Client.second_session),
-                         or_(and_(Client.first_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
-                             and_(Client.second_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
+        q = q.filter(session_ordinal == 2)
       if world_third:
-        q = q.filter(or_(and_(Client.third_session != 4, File.session_id == Client.third_session),
-                         or_(and_(Client.second_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
-                             and_(Client.third_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
+        q = q.filter(session_ordinal == 3)
       if world_fourth:
-        q = q.filter(or_(and_(Client.fourth_session != 4, File.session_id == Client.fourth_session),
-                         or_(and_(Client.third_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
-                             and_(Client.fourth_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
+        q = q.filter(session_ordinal == 4)
       if model_ids:
         q = q.filter(Client.id.in_(model_ids))
-      q = q.order_by(File.client_id, File.session_id,
-                     File.recording_id, File.id)
-      retval += list(q)
+      queries.append(q)
 
     if ('dev' in groups or 'eval' in groups):
       if('enroll' in purposes):
-        q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-            filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                groups), ProtocolPurpose.purpose == 'enroll'))
+        q = self._members_query(protocol, groups, 'enroll')
         if expressions:
           q = q.join(Expression).filter(Expression.name.in_(expressions))
         if cameras:
@@ -497,15 +895,11 @@ class Database(bob.db.base.SQLiteDatabase):
               Camera).filter(Camera.name.in_(cameras))
         if model_ids:
           q = q.filter(Client.id.in_(model_ids))
-        q = q.order_by(File.client_id, File.session_id,
-                       File.recording_id, File.id)
-        retval += list(q)
+        queries.append(q)
 
       if('probe' in purposes):
         if('client' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                  groups), ProtocolPurpose.purpose == 'probe'))
+          q = self._members_query(protocol, groups, 'probe')
           if expressions:
             q = q.join(Expression).filter(Expression.name.in_(expressions))
           if cameras:
@@ -513,14 +907,10 @@ class Database(bob.db.base.SQLiteDatabase):
                 Camera).filter(Camera.name.in_(cameras))
           if model_ids:
             q = q.filter(Client.id.in_(model_ids))
-          q = q.order_by(File.client_id, File.session_id,
-                         File.recording_id, File.id)
-          retval += list(q)
+          queries.append(q)
 
         if('impostor' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                  groups), ProtocolPurpose.purpose == 'probe'))
+          q = self._members_query(protocol, groups, 'probe')
           if expressions:
             q = q.join(Expression).filter(Expression.name.in_(expressions))
           if cameras:
@@ -528,11 +918,9 @@ class Database(bob.db.base.SQLiteDatabase):
                 Camera).filter(Camera.name.in_(cameras))
           if len(model_ids) == 1:
             q = q.filter(not_(Client.id.in_(model_ids)))
-          q = q.order_by(File.client_id, File.session_id,
-                         File.recording_id, File.id)
-          retval += list(q)
+          queries.append(q)
 
-    return list(set(retval))  # To remove duplicates
+    return queries
 
   def tobjects(self, protocol=None, model_ids=None, groups=None, expressions=None):
     """Returns a set of filenames for enrolling T-norm models for score
@@ -627,47 +1015,190 @@ class Database(bob.db.base.SQLiteDatabase):
     if self.annotation_directory is None:
       return None
 
-    annotation_file = file.make_path(
-        self.annotation_directory, self.annotation_extension)
-
-    if not os.path.exists(annotation_file):
-      raise IOError("The annotation file '%s' was not found" % annotation_file)
-
-    # read annotations from file
-    annotations = {}
-    with open(annotation_file) as f:
-      count = int(f.readline())
-      if count == 6:
-        # profile annotations
-        labels = ['eye', 'nose', 'mouth', 'lipt', 'lipb', 'chin']
-      elif count == 8:
-        # half profile annotations
-        labels = ['reye', 'leye', 'nose', 'mouthr',
-                  'mouthl', 'lipt', 'lipb', 'chin']
-      elif count == 16:
-        # frontal image annotations
-        labels = ['reye', 'leye', 'reyeo', 'reyei', 'leyei', 'leyeo', 'nose', 'mouthr',
-                  'mouthl', 'lipt', 'lipb', 'chin', 'rbrowo', 'rbrowi', 'lbrowi', 'lbrowo']
-      elif count == 2:
-        # for inclomplete annotations, only the two eye locations are available
-        labels = ['reye', 'leye']
-      else:
-        raise ValueError("The number %d of annotations in file '%s' is not handled." % (
-            count, annotation_file))
-
-      for i in range(count):
-        line = f.readline()
-        positions = line.split()
-        assert len(positions) == 2
-        annotations[labels[i]] = (float(positions[1]), float(positions[0]))
-
-    # done.
-    return annotations
+    store = self._annotation_store()
+    if store is not None:
+      annotations = store.get(file.id)
+      if annotations is not None:
+        return annotations
+
+    return self._read_annotations(file)
+
+  def _read_annotations(self, file):
+    """Reads the annotations of the given file from its annotation file, or
+    takes them from the cache of annotations"""
+
+    path = file.make_path(self.annotation_directory, self.annotation_extension)
+    key = self._annotation_key(file, path)
+    annotations = self._annotation_cache.get(key) if key is not None else None
+    if annotations is None:
+      annotations = read_annotation_file(path)
+      if key is not None:
+        self._annotation_cache.put(key, annotations)
+    # the cached dictionary must not be modified by the caller
+    return dict(annotations)
+
+  def _annotation_key(self, file, path):
+    """Returns the key of the annotations of the given file in the cache of
+    annotations, or None if the cache is disabled or the annotation file does
+    not exist"""
+
+    if self._annotation_cache.capacity <= 0:
+      return None
+    try:
+      return (file.id, os.stat(path).st_mtime)
+    except OSError:
+      return None
+
+  def annotations_many(self, files, threads=8, errors=None):
+    """Reads the annotations of several files concurrently, see
+    :py:meth:`annotations`.
+
+    Keyword parameters:
+
+    files
+      The files for which the annotations should be read.
+
+    threads
+      The number of annotation files that are read at the same time.
+
+    errors
+      If a dictionary is given, the exception raised while reading the
+      annotations of a file is stored in it, with the file id as key.
+
+    Return value
+      A dictionary with the file ids as keys and the annotations of the files
+      as values; the annotations are None for files whose annotations could not
+      be read.
+    """
+    files = list(files)
+    if self.annotation_directory is None:
+      return dict((f.id, None) for f in files)
+
+    store = self._annotation_store()
+    result = dict((f.id, store.get(f.id) if store is not None else None) for f in files)
+
+    # read the files that are not in the store; the modification times of the
+    # annotation files are checked for the cache by the threads, too
+    missing = [f for f in files if result[f.id] is None]
+    failures = {}
+    annotations = read_annotation_files(missing, threads, failures, read=self._read_annotations)
+    if errors is not None:
+      for i, error in failures.items():
+        errors[missing[i].id] = error
+    result.update((f.id, a) for f, a in zip(missing, annotations))
+    return result
+
+  def annotation_array(self, files=None, threads=8, errors=None, **kwargs):
+    """Returns the annotations of several files as a single array, e.g., to
+    train models on the annotations of a protocol. The annotations are taken
+    from the annotation store where possible (see
+    :py:meth:`compile_annotations`), and the remaining annotation files are
+    read concurrently, see :py:meth:`annotations_many`.
+
+    Keyword parameters:
+
+    files
+      The files for which the annotations should be returned; by default, the
+      files returned by :py:meth:`objects` for the given ``kwargs``.
+
+    threads
+      The number of annotation files that are read at the same time.
+
+    errors
+      If a dictionary is given, the exception raised while reading the
+      annotations of a file is stored in it, with the file id as key.
+
+    kwargs
+      The parameters of :py:meth:`objects` that select the files, if no
+      ``files`` are given.
+
+    Return value
+      A structured numpy array with one entry per file, with the fields ``id``
+      (the file id), ``labelset`` (the code of the set of labels:
+      0 for no annotations, 1 for the eyes only, 2 for profile, 3 for half
+      profile and 4 for frontal images) and ``coordinates`` (a 16x2 array with
+      the (y, x) coordinates of the points, in the order of
+      ``bob.db.multipie.annotations.LABELS``, padded with NaN).
+    """
+    if files is None:
+      files = self.objects(**kwargs)
+    elif kwargs:
+      raise ValueError("The files and the parameters of objects() cannot be given both")
+    files = list(files)
+    ids = [f.id for f in files]
+    if self.annotation_directory is None:
+      return annotation_array(ids, [None] * len(files))
+
+    store = self._annotation_store()
+    array = store.array(ids) if store is not None else annotation_array(ids, [None] * len(files))
+
+    # read the files that are not in the store
+    missing = numpy.flatnonzero(array['labelset'] == 0)
+    if len(missing):
+      annotations = self.annotations_many([files[i] for i in missing], threads, errors)
+      array[missing] = annotation_array(array['id'][missing], [annotations[files[i].id] for i in missing])
+    return array
+
+  def _annotation_store_directory(self):
+    """Returns the directory of the annotation store, or None"""
+
+    if self.annotation_store is not None:
+      return self.annotation_store
+    if self.annotation_directory is not None:
+      return os.path.join(self.annotation_directory, STORE_NAME)
+    return None
+
+  def _annotation_store(self):
+    """Returns the annotation store, if there is one that was compiled for the
+    files of the database, i.e., with the same ids and paths, or None. The
+    store is opened once, and again when the database file changes."""
+
+    self._check_database()
+    if self._store is False:
+      self._store = None
+      directory = self._annotation_store_directory()
+      if directory is not None and os.path.exists(os.path.join(directory, 'meta.json')):
+        store = AnnotationStore(directory)
+        if store.matches(files_digest(self.query(File.id, File.path)), self.annotation_extension):
+          self._store = store
+    return self._store
+
+  def compile_annotations(self, directory=None, threads=8):
+    """Compiles the annotation files of all files of the database into an
+    annotation store, which :py:meth:`annotations` uses afterwards instead of
+    the annotation files. The annotation files are read from the
+    ``annotation_directory``; files whose annotations cannot be read are
+    stored without annotations.
+
+    Keyword parameters:
+
+    directory
+      The directory of the store; by default, the ``annotation_store`` or the
+      sub-directory ``annotations.store`` of the ``annotation_directory`` is
+      used.
+
+    threads
+      The number of annotation files that are read at the same time.
+
+    Return value
+      The number of files with annotations in the store.
+    """
+    if self.annotation_directory is None:
+      raise ValueError("The annotation directory is required to compile the annotations")
+    if directory is None:
+      directory = self._annotation_store_directory()
+
+    files = self.query(File.id, File.path).order_by(File.id).all()
+    annotations = read_annotation_files([os.path.join(self.annotation_directory, path + self.annotation_extension) for _, path in files],
+                                        threads)
+    count = write_annotation_store(directory, files, annotations, self.annotation_extension)
+    self._store = False
+    return count
 
   def protocol_names(self):
     """Returns all registered protocol names"""
 
-    return [str(p.name) for p in self.protocols()]
+    return list(self._metadata()['protocols'])
 
   def protocols(self):
     """Returns all registered protocols"""
@@ -677,7 +1208,7 @@ class Database(bob.db.base.SQLiteDatabase):
   def has_protocol(self, name):
     """Tells if a certain protocol is available"""
 
-    return self.query(Protocol).filter(Protocol.name == name).count() != 0
+    return name in self._metadata()['protocols_set']
 
   def protocol(self, name):
     """Returns the protocol object in the database given a certain name. Raises
@@ -39,6 +39,26 @@ def db_available(test):
 
   return wrapper
 
+def database_content(dbfile):
+  """Returns the content of the given database file, where the files are
+  identified by their paths instead of their ids"""
+  import sqlite3
+  connection = sqlite3.connect(dbfile)
+  try:
+    rows = lambda statement: sorted(connection.execute(statement).fetchall())
+    return {
+      'clients': rows('SELECT * FROM client'),
+      'subworlds': rows('SELECT s.name, a.client_id FROM subworld s JOIN subworld_client_association a ON a.subworld_id = s.id'),
+      'expressions': rows('SELECT name FROM expression'),
+      'cameras': rows('SELECT name FROM camera'),
+      'files': rows('SELECT f.path, f.client_id, f.session_id, f.recording_id, f.img_type, e.name, f.session_ordinal, m.shot_id, c.name, m.shot_index '
+                    'FROM file f JOIN expression e ON e.id = f.expression_id LEFT JOIN fileMultiview m ON m.id = f.id LEFT JOIN camera c ON c.id = m.camera_id'),
+      'protocols': rows('SELECT p.name, pu.sgroup, pu.purpose, f.path FROM protocolPurpose_file_association a '
+                        'JOIN protocolPurpose pu ON pu.id = a.protocolPurpose_id JOIN protocol p ON p.id = pu.protocol_id JOIN file f ON f.id = a.file_id'),
+    }
+  finally:
+    connection.close()
+
 
 @db_available
 def test_clients():
@@ -58,7 +78,9 @@ def test_clients():
   assert len(c_world) == 208 #208 clients in the world set
   # Check client ids
   assert db.has_client_id(1)
+  assert db.has_client_id('1')
   assert not db.has_client_id(395)
+  assert not db.has_client_id('x')
   # Check subworld
   assert len(db.clients(groups='world', subworld='sub41')) == 41
   assert len(db.clients(groups='world', subworld='sub81')) == 81
@@ -102,6 +124,375 @@ def test_objects():
   assert len(db.zobjects()) > 0
   assert len(db.tobjects()) > 0
 
+  # a single model id may be given without a sequence
+  model_id = db.model_ids(groups='dev')[0]
+  files = db.objects(groups='dev', purposes='enroll', model_ids=model_id)
+  assert files and [f.id for f in files] == [f.id for f in db.objects(groups='dev', purposes='enroll', model_ids=[model_id])]
+
+
+@db_available
+def test_objects_index():
+
+  db = bob.db.multipie.Database()
+  index_db = bob.db.multipie.Database(use_index=True)
+
+  # the in-memory index must return the same files, in the same order, as the SQL query
+  model_ids = db.model_ids(groups='dev')[:2]
+  queries = [{}, {'groups': 'world'}, {'groups': 'world', 'world_nshots': 25}, {'groups': 'world', 'world_sampling': 3},
+             {'groups': 'world', 'world_first': True}, {'groups': 'world', 'world_noflash': True, 'subworld': 'sub41'},
+             {'groups': 'dev', 'purposes': 'probe', 'classes': 'impostor', 'model_ids': model_ids[:1]},
+             {'groups': ('dev', 'eval'), 'purposes': 'enroll', 'model_ids': model_ids, 'expressions': 'neutral'}]
+  for protocol in db.protocol_names()[:3]:
+    for query in queries:
+      files = db.objects(protocol=protocol, **query)
+      assert [f.id for f in files] == [f.id for f in index_db.objects(protocol=protocol, **query)]
+
+
+@db_available
+def test_world_sessions():
+
+  db = bob.db.multipie.Database()
+  for f in db.objects(groups='world', world_first=True):
+    c = f.client
+    assert f.session_id == c.first_session and (c.first_session != 4 or f.recording_id == 1)
+  for f in db.objects(groups='world', world_nshots=10):
+    c = f.client
+    assert f.session_id == c.first_session and f.recording_id == 1 and f.file_multiview.shot_id < 10
+
+
+def test_read_subworlds():
+
+  from bob.db.multipie.create import read_subworlds
+  import tempfile
+  with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+    f.write("# name and clients\nsubA 1 7\n\nsubB 12\n")
+    f.flush()
+    assert read_subworlds(f.name) == [('subA', [1, 7]), ('subB', [12])]
+    # a subworld cannot be defined twice
+    f.write("subA 13\n")
+    f.flush()
+    try:
+      read_subworlds(f.name)
+      assert False
+    except ValueError:
+      pass
+
+
+def test_add_subworlds():
+
+  import tempfile, shutil
+  from sqlalchemy import create_engine
+  from sqlalchemy.orm import sessionmaker
+  from bob.db.multipie.models import Base, subworld_client_association
+  from bob.db.multipie.create import add_clients, add_subworlds
+  from bob.db.multipie.benchmark import write_tree
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    write_tree(directory, clients=[])
+    session = sessionmaker(bind=create_engine('sqlite://'))()
+    Base.metadata.create_all(session.get_bind())
+    add_clients(session, os.path.join(directory, 'subjects.txt'), 0)
+    add_subworlds(session, 0)
+    rows = session.query(subworld_client_association).all()
+    assert len(rows) == 41 + 81 + 121 + 161
+    # a subworld without clients does not change the association table
+    with open(os.path.join(directory, 'subworlds.txt'), 'w') as f:
+      f.write('empty\n')
+    add_subworlds(session, 0, os.path.join(directory, 'subworlds.txt'))
+    assert session.query(bob.db.multipie.Subworld).filter_by(name='empty').one().clients == []
+    assert session.query(subworld_client_association).all() == rows
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_scan_files():
+
+  import tempfile, shutil
+  from bob.db.multipie.benchmark import write_tree
+  from bob.db.multipie.create import scan_files
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    count = write_tree(directory, clients=[1, 2, 7, 11])
+    imagedir = os.path.join(directory, 'data')
+    stems = list(scan_files(imagedir, True, True, jobs=1))
+    assert len(stems) == count
+    # sorted by session, image type (multiview first) and the names below
+    def order(stem):
+      parts = stem.split('/')
+      return (parts[0], parts[1] != 'multiview', parts[2:])
+    assert stems == sorted(stems, key=order)
+    for jobs in (2, 8):
+      assert list(scan_files(imagedir, True, True, jobs=jobs)) == stems
+    assert list(scan_files(imagedir, False, False, jobs=4)) == [s for s in stems if '/05_1/' in s]
+
+    # errors of the listings are raised, not swallowed
+    shutil.rmtree(os.path.join(imagedir, 'session04', 'highres'))
+    try:
+      list(scan_files(imagedir, True, True, jobs=4))
+      assert False
+    except OSError:
+      pass
+    camera = os.path.join(imagedir, 'session01', 'multiview', '001', '01', '19_0')
+    shutil.rmtree(camera)
+    open(camera, 'w').close()
+    try:
+      list(scan_files(imagedir, True, False, jobs=4))
+      assert False
+    except OSError:
+      pass
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_incremental_create():
+
+  import tempfile, shutil, sqlite3
+  from bob.db.multipie.benchmark import write_tree, create_database
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    write_tree(directory, clients=[1, 2, 7, 11])
+    options = ['-P', '-E', '-H', '--batch-size', '500']
+    full = os.path.join(directory, 'full.sql3')
+    create_database(directory, full, options)
+
+    # a first build without the last two sessions
+    partial = os.path.join(directory, 'partial.sql3')
+    sessions = ['session03', 'session04']
+    for session in sessions:
+      os.rename(os.path.join(directory, 'data', session), os.path.join(directory, session))
+    create_database(directory, partial, options)
+    for session in sessions:
+      os.rename(os.path.join(directory, session), os.path.join(directory, 'data', session))
+    # which had no ordinal columns yet (SQLite can drop columns since version 3.35)
+    if sqlite3.sqlite_version_info >= (3, 35):
+      connection = sqlite3.connect(partial)
+      for table, column in (('file', 'session_ordinal'), ('fileMultiview', 'shot_index')):
+        connection.execute('DROP INDEX "ix_%s_%s"' % (table, column))
+        connection.execute('ALTER TABLE "%s" DROP COLUMN "%s"' % (table, column))
+      connection.commit()
+      connection.close()
+
+    # the incremental builds add the missing files, protocol entries and ordinals only
+    for k in range(2):
+      create_database(directory, partial, options + ['--incremental'])
+      assert database_content(partial) == database_content(full)
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_manifest_create():
+
+  import tempfile, shutil, sqlite3, gzip, random
+  from bob.db.multipie.benchmark import write_tree, create_database
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    write_tree(directory, clients=[1, 2, 7, 11])
+    imagedir = os.path.join(directory, 'data')
+    scanned = os.path.join(directory, 'scanned.sql3')
+    create_database(directory, scanned, ['-P', '-H'])
+
+    # a shuffled manifest with relative and absolute paths gives the same file ids
+    paths = [os.path.join(root, name) for root, _, names in os.walk(imagedir) for name in names]
+    paths = [os.path.relpath(p, imagedir) if i % 2 else p for i, p in enumerate(paths)]
+    random.Random(1).shuffle(paths)
+    manifest = os.path.join(directory, 'manifest.txt.gz')
+    with gzip.open(manifest, 'wt') as f:
+      f.write('\n'.join(paths) + '\n')
+    listed = os.path.join(directory, 'listed.sql3')
+    create_database(directory, listed, ['-P', '-H', '--manifest', manifest, '--batch-size', '100'])
+    rows = lambda dbfile: sqlite3.connect(dbfile).execute('SELECT id, path FROM file ORDER BY id').fetchall()
+    assert rows(listed) == rows(scanned)
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_parallel_create():
+
+  import tempfile, shutil, sqlite3
+  from bob.db.multipie.benchmark import write_tree, create_database
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    write_tree(directory, clients=[1, 2, 7, 11])
+    options = ['-P', '-E', '-H', '--batch-size', '500']
+    sequential = os.path.join(directory, 'sequential.sql3')
+    create_database(directory, sequential, options + ['-p', '1'])
+    # the sessions are ingested into shards, which are merged into the database
+    parallel = os.path.join(directory, 'parallel.sql3')
+    create_database(directory, parallel, options + ['-p', '3'])
+    assert database_content(parallel) == database_content(sequential)
+    # the files even get the same ids
+    rows = lambda dbfile: sqlite3.connect(dbfile).execute('SELECT id, path FROM file ORDER BY id').fetchall()
+    assert rows(parallel) == rows(sequential)
+    # files that are already stored are not merged again
+    create_database(directory, parallel, options + ['-p', '3', '--incremental'])
+    assert database_content(parallel) == database_content(sequential)
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_fast_create():
+
+  import tempfile, shutil, sqlite3
+  from bob.db.multipie.benchmark import write_tree, create_database
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    write_tree(directory, clients=[1, 2, 7, 11])
+    options = ['-P', '-E', '-H', '--batch-size', '500']
+    normal = os.path.join(directory, 'normal.sql3')
+    create_database(directory, normal, options)
+    fast = os.path.join(directory, 'fast.sql3')
+    create_database(directory, fast, options + ['--fast'])
+    assert database_content(fast) == database_content(normal)
+    rows = lambda dbfile: sqlite3.connect(dbfile).execute('SELECT id, path FROM file ORDER BY id').fetchall()
+    assert rows(fast) == rows(normal)
+
+    # a failing build keeps the current database and removes its temporary file
+    with open(fast, 'rb') as f:
+      content = f.read()
+    subworlds = os.path.join(directory, 'subworlds.txt')
+    with open(subworlds, 'w') as f:
+      f.write('unknown 1 999\n')
+    for option in ('--recreate', '--incremental'):
+      try:
+        create_database(directory, fast, options + ['--fast', option, '--subworlds', subworlds])
+        assert False
+      except ValueError:
+        pass
+      with open(fast, 'rb') as f:
+        assert f.read() == content
+      assert [name for name in os.listdir(directory) if name.endswith('.tmp')] == []
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_create_report():
+
+  import tempfile, shutil, sqlite3
+  from bob.db.multipie.benchmark import write_tree, create_database
+  from bob.db.multipie.create import Profiler
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    write_tree(directory, clients=[1, 2, 7, 11])
+    dbfile = os.path.join(directory, 'db.sql3')
+    profiler = Profiler()
+    create_database(directory, dbfile, ['-P', '--fast', '--batch-size', '500'], profiler)
+    phases = dict((p['name'], p) for p in profiler.report()['phases'])
+    connection = sqlite3.connect(dbfile)
+    count = lambda statement: connection.execute(statement).fetchone()[0]
+    # the inserted and the updated rows are counted
+    assert phases['add_files']['rows'] == sum(count('SELECT COUNT(*) FROM "%s"' % table) for table in ('expression', 'camera', 'file', 'fileMultiview'))
+    assert phases['add_ordinals']['rows'] == count('SELECT COUNT(session_ordinal) FROM file') + count('SELECT COUNT(shot_index) FROM fileMultiview')
+    connection.close()
+    # ANALYZE and VACUUM
+    assert phases['finalize']['statements'] == 2
+  finally:
+    shutil.rmtree(directory)
+
+
+@db_available
+def test_ordinal_expressions():
+
+  from bob.db.multipie.models import session_ordinal_expression, shot_index_expression
+  db = bob.db.multipie.Database()
+  File, FileMultiview, Client = bob.db.multipie.File, bob.db.multipie.FileMultiview, bob.db.multipie.Client
+  # the expressions used for older databases give the stored values
+  q = db.query(File.session_ordinal, session_ordinal_expression(), FileMultiview.shot_index, shot_index_expression()).\
+      join(Client).outerjoin(FileMultiview)
+  for ordinal, expected_ordinal, index, expected_index in q:
+    assert ordinal == expected_ordinal and index == expected_index
+
+
+@db_available
+def test_iter_objects():
+
+  db = bob.db.multipie.Database()
+  for query in [{}, {'groups': 'world', 'world_nshots': 30}, {'groups': 'dev', 'purposes': 'probe'}]:
+    assert [f.id for f in db.iter_objects(batch_size=100, **query)] == [f.id for f in db.objects(**query)]
+
+
+@db_available
+def test_lite_objects():
+
+  db = bob.db.multipie.Database()
+  files = db.objects(groups='world')
+  records = db.objects(groups='world', lite=True)
+  assert [r.id for r in records] == [f.id for f in files]
+  for f, r in zip(files[:100], records):
+    assert isinstance(r, bob.db.multipie.FileRecord)
+    assert r.make_path('dir', '.png') == f.make_path('dir', '.png')
+    assert r.shot_id == f.file_multiview.shot_id
+    assert r.camera == f.file_multiview.camera.name
+
+
+@db_available
+def test_eager_objects():
+
+  from sqlalchemy import event
+  db = bob.db.multipie.Database()
+  db.protocol_names()
+
+  statements = []
+  def count(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+  engine = db.m_session.bind
+  event.listen(engine, 'before_cursor_execute', count)
+  try:
+    for query in [{'groups': 'world'}, {'groups': 'world', 'world_nshots': 2}]:
+      del statements[:]
+      files = db.objects(eager=True, **query)
+      for f in files:
+        f.client.gender, f.expression.name
+        if f.file_multiview is not None:
+          f.file_multiview.shot_id, f.file_multiview.camera.name
+      # a single query, whatever the number of files
+      assert len(statements) == 1, len(statements)
+  finally:
+    event.remove(engine, 'before_cursor_execute', count)
+
+
+@db_available
+def test_query_cache():
+
+  db = bob.db.multipie.Database(query_cache_size=4)
+
+  files = db.objects(groups='world')
+  assert db.query_cache_info()['misses'] == 1
+  # the same query, written differently, is answered from the cache
+  assert db.objects(groups=['world'], purposes=('probe', 'train', 'enroll')) == files
+  assert db.query_cache_info()['hits'] == 1
+  assert len(db.clients(groups='dev')) == 64
+  assert len(db.clients(groups=('dev',))) == 64
+  assert db.query_cache_info()['hits'] == 2
+
+
+@db_available
+def test_result_store():
+
+  import tempfile, shutil
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    files = bob.db.multipie.Database().objects(groups='world')
+    db = bob.db.multipie.Database(cache_directory=directory)
+    assert sorted(f.id for f in db.objects(groups='world')) == sorted(f.id for f in files)
+    # another database instance reads the stored ids
+    db = bob.db.multipie.Database(cache_directory=directory)
+    assert sorted(db.object_ids(groups=('world',))) == sorted(f.id for f in files)
+    # all spellings of the same query share the stored result
+    db.object_ids()
+    db.object_ids(groups=db.groups(), purposes=db.purposes(), protocol=db.protocol_names())
+    stored = [name for _, _, names in os.walk(directory) for name in names if name.endswith('.npy')]
+    assert len(stored) == 2
+    # the files of a query that was not stored yet are read only once
+    db = bob.db.multipie.Database(cache_directory=directory)
+    db.protocol_names()
+    statements = []
+    from sqlalchemy import event
+    event.listen(db.m_session.bind, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+    assert sorted(f.id for f in db.objects(groups='dev')) == sorted(db.object_ids(groups='dev'))
+    assert len(statements) == 1
+  finally:
+    shutil.rmtree(directory)
+
 
 @db_available
 def test_annotations():
@@ -117,6 +508,161 @@ def test_annotations():
     assert annotations is not None
 
 
+@db_available
+def test_annotations_many():
+
+  import tempfile, shutil
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    db = bob.db.multipie.Database(annotation_directory=directory)
+    files = db.objects()[:3]
+    # write annotation files for the first two files only
+    for f, lines in zip(files[:2], (['2', '10 20', '30 40'], ['5'])):
+      path = f.make_path(directory, '.pos')
+      if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as w:
+        w.write('\n'.join(lines) + '\n')
+    errors = {}
+    annotations = db.annotations_many(files, threads=2, errors=errors)
+    assert annotations[files[0].id] == {'reye': (20., 10.), 'leye': (40., 30.)}
+    assert annotations[files[1].id] is None and isinstance(errors[files[1].id], ValueError)
+    assert annotations[files[2].id] is None and isinstance(errors[files[2].id], IOError)
+  finally:
+    shutil.rmtree(directory)
+
+
+@db_available
+def test_annotation_store():
+
+  import tempfile, shutil
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    db = bob.db.multipie.Database(annotation_directory=directory)
+    files = db.objects()[:2]
+    path = files[0].make_path(directory, '.pos')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as w:
+      w.write('2\n10 20\n30 40\n')
+    assert db.compile_annotations() == 1
+    # the annotations are now read from the store, not from the file
+    os.remove(path)
+    assert db.annotations(files[0]) == {'reye': (20., 10.), 'leye': (40., 30.)}
+    assert bob.db.multipie.Database(annotation_directory=directory).annotations(files[0]) == {'reye': (20., 10.), 'leye': (40., 30.)}
+    # files without annotations in the store are still read from file
+    try:
+      db.annotations(files[1])
+      assert False
+    except IOError:
+      pass
+    # stores of other annotation files are not used
+    other = bob.db.multipie.Database(annotation_directory=directory, annotation_extension='.txt')
+    assert other.annotations_many(files[:1])[files[0].id] is None
+    # stores that were compiled without the digest of the files are not used
+    import json
+    meta_file = os.path.join(directory, 'annotations.store', 'meta.json')
+    with open(meta_file) as f:
+      meta = json.load(f)
+    del meta['digest']
+    with open(meta_file, 'w') as f:
+      json.dump(meta, f)
+    other = bob.db.multipie.Database(annotation_directory=directory)
+    assert other.annotations_many(files[:1])[files[0].id] is None
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_annotation_store_digest():
+
+  import tempfile, shutil
+  from .annotations import write_annotation_store, files_digest, AnnotationStore
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    files = [(1, 'a'), (2, 'b'), (3, 'c')]
+    write_annotation_store(directory, files, [{'reye': (1., 2.), 'leye': (3., 4.)}, None, None], '.pos')
+    store = AnnotationStore(directory)
+    assert store.matches(files_digest(reversed(files)), '.pos')
+    # a database with the same ids, but for other files, does not match
+    assert not store.matches(files_digest([(1, 'b'), (2, 'a'), (3, 'c')]), '.pos')
+    assert not store.matches(files_digest(files), '.txt')
+  finally:
+    shutil.rmtree(directory)
+
+
+@db_available
+def test_annotation_cache():
+
+  import tempfile, shutil
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    db = bob.db.multipie.Database(annotation_directory=directory, annotation_cache_size=1)
+    f = db.objects()[0]
+    path = f.make_path(directory, '.pos')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as w:
+      w.write('2\n10 20\n30 40\n')
+    assert db.annotations(f) == {'reye': (20., 10.), 'leye': (40., 30.)}
+    db.annotations(f)['reye'] = None
+    assert db.annotations(f) == {'reye': (20., 10.), 'leye': (40., 30.)}
+    assert db.annotation_cache_info() == {'hits': 2, 'misses': 1, 'size': 1, 'capacity': 1}
+    # modified annotation files are read again
+    with open(path, 'w') as w:
+      w.write('2\n50 60\n70 80\n')
+    os.utime(path, (1, 1))
+    assert db.annotations_many([f])[f.id] == {'reye': (60., 50.), 'leye': (80., 70.)}
+    assert db.annotation_cache_info()['misses'] == 2
+  finally:
+    shutil.rmtree(directory)
+
+
+@db_available
+def test_annotation_array():
+
+  import tempfile, shutil, numpy
+  directory = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    db = bob.db.multipie.Database(annotation_directory=directory)
+    files = db.objects()[:3]
+    for f, lines in zip(files[:2], (['2', '10 20', '30 40'], ['6'] + ['%d 1' % i for i in range(6)])):
+      path = f.make_path(directory, '.pos')
+      if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as w:
+        w.write('\n'.join(lines) + '\n')
+    for compiled in (False, True):
+      if compiled:
+        db.compile_annotations()
+      array = db.annotation_array(files)
+      assert list(array['id']) == [f.id for f in files]
+      assert list(array['labelset']) == [1, 2, 0]
+      assert array['coordinates'].shape == (3, 16, 2)
+      assert array['coordinates'][0, :2].tolist() == [[20., 10.], [40., 30.]]
+      assert array['coordinates'][1, :6, 0].tolist() == [1.] * 6
+      assert numpy.isnan(array['coordinates'][0, 2:]).all() and numpy.isnan(array['coordinates'][2]).all()
+  finally:
+    shutil.rmtree(directory)
+
+
+@db_available
+def test_async_database():
+
+  import asyncio
+  db = bob.db.multipie.Database()
+
+  async def query():
+    async with bob.db.multipie.AsyncDatabase(max_workers=2) as adb:
+      return await asyncio.gather(adb.objects(lite=True), adb.object_ids(groups='dev'), adb.clients(), adb.run(bob.db.multipie.Database.protocol_names),
+                                  adb.run(lambda database: database))
+
+  files, ids, clients, protocols, database = asyncio.run(query())
+  # the databases of the threads are closed with the AsyncDatabase
+  assert database.m_session is None
+  assert files == db.objects(lite=True)
+  assert list(ids) == list(db.object_ids(groups='dev'))
+  assert [c.id for c in clients] == [c.id for c in db.clients()]
+  assert protocols == db.protocol_names()
+
+
 @db_available
 def test_driver_api():
 